@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the filters of lab.py.
+
+The suite times correlate, blurred, sharpened and edges on synthetic
+greyscale images, reporting throughput in megapixels per second and peak
+memory, and stores the results as JSON so runs from different commits can be
+compared:
+   python3 benchmark.py suite --sizes 256 1024 --output before.json
+   python3 benchmark.py suite --sizes 256 1024 --compare before.json
+
+The crossover mode measures the correlation methods ('direct', 'separable',
+'fft') and reports the per-unit costs to put in lab.CORRELATION_COSTS,
+together with the fastest method for each kernel size:
+   python3 benchmark.py crossover --sizes 64 256 --kernels 3 5 9 15 25
+"""
+
+import sys
+import math
+import random
+import argparse
+
+import lab
+from benchmark_helpers import (time_call, peak_memory, write_results,
+                               compare_results)
+
+
+def random_image(width, height, seed=0):
+    """
+    Returns a width x height greyscale image with random pixels.
+    """
+    rng = random.Random(seed)
+    return {
+        'height': height,
+        'width': width,
+        'pixels': [rng.randrange(256) for _ in range(width * height)],
+    }
+
+
+def random_kernel(n, seed=0):
+    """
+    Returns a random (not separable) nxn kernel with no zero taps.
+    """
+    rng = random.Random(seed)
+    return {'size': n, 'flat_kernel': [rng.random() + 0.5 for _ in range(n * n)]}
+
+
+def correlation_timings(sizes, kernel_sizes, backend='python'):
+    """
+    Returns a list of (size, n, method, seconds) for correlating size x size
+    images with nxn kernels using every method available in the backend.
+    """
+    lab.set_backend(backend)
+    methods = ['direct', 'fft'] if backend == 'numpy' else ['direct', 'separable', 'fft']
+    if lab.np is None:
+        methods.remove('fft')
+    timings = []
+    try:
+        for size in sizes:
+            image = random_image(size, size)
+            for n in kernel_sizes:
+                kernel = random_kernel(n)
+                box = lab.get_boxblur(n)
+                for method in methods:
+                    # The separable method needs a separable kernel
+                    k = box if method == 'separable' else kernel
+                    seconds = time_call(lambda: lab.correlate(image, k, method=method))
+                    timings.append((size, n, method, seconds))
+    finally:
+        lab.set_backend('python')
+    return timings
+
+
+# (name, function of (image, n)); n is None for filters without a kernel
+FILTER_BENCHMARKS = [
+    ('correlate', lambda image, n: lab.correlate(image, random_kernel(n))),
+    ('blurred', lab.blurred),
+    ('sharpened', lab.sharpened),
+    ('edges', None),
+]
+
+
+def run_suite(sizes, kernel_sizes, names=None, repeat=3, memory=True):
+    """
+    Runs the filter benchmarks (all of them, or those in names) on size x size
+    images with each kernel size, and returns a list of result dictionaries.
+    """
+    results = []
+    for size in sizes:
+        image = random_image(size, size)
+        for name, func in FILTER_BENCHMARKS:
+            if names and name not in names:
+                continue
+            if func is None:
+                calls = [(None, lambda: lab.edges(image))]
+            else:
+                calls = [(n, lambda n=n: func(image, n)) for n in kernel_sizes]
+            for n, call in calls:
+                seconds = time_call(call, repeat)
+                results.append({
+                    'name': name,
+                    'size': size,
+                    'n': n,
+                    'seconds': seconds,
+                    'megapixels_per_second': size * size / seconds / 1e6,
+                    'peak_bytes': peak_memory(call) if memory else None,
+                })
+                print('%-10s %6d %4s %10.4fs %10.3f MP/s' % (
+                    name, size, n or '-', seconds, results[-1]['megapixels_per_second']))
+    return results
+
+
+def unit_costs(timings):
+    """
+    Returns the median cost per unit of work of each method: per pixel per
+    tap for 'direct' and 'separable', per element * log2(elements) of the
+    padded image for 'fft'.
+    """
+    samples = {}
+    for size, n, method, seconds in timings:
+        if method == 'direct':
+            units = size * size * n * n
+        elif method == 'separable':
+            units = size * size * 2 * n
+        else:
+            padded = (size + n - 1) ** 2
+            units = padded * math.log2(padded + 1)
+        samples.setdefault(method, []).append(seconds / units)
+    return {method: sorted(costs)[len(costs) // 2] for method, costs in samples.items()}
+
+
+def crossovers(timings):
+    """
+    Returns, for each image size, the fastest method for each kernel size.
+    """
+    fastest = {}
+    for size, n, method, seconds in timings:
+        best = fastest.get((size, n))
+        if best is None or seconds < best[1]:
+            fastest[size, n] = (method, seconds)
+    return {key: method for key, (method, _) in fastest.items()}
+
+
+def crossover_main(parsed):
+    timings = correlation_timings(parsed.sizes, parsed.kernels, parsed.backend)
+    print('%6s %4s %10s %12s' % ('size', 'n', 'method', 'seconds'))
+    for size, n, method, seconds in timings:
+        print('%6d %4d %10s %12.6f' % (size, n, method, seconds))
+
+    print('\nfastest method:')
+    for (size, n), method in sorted(crossovers(timings).items()):
+        print('%6d %4d %10s' % (size, n, method))
+
+    print('\nunit costs (seconds):')
+    for method, cost in sorted(unit_costs(timings).items()):
+        print('%10s %.3g' % (method, cost))
+
+
+def suite_main(parsed):
+    lab.set_backend(parsed.backend)
+    results = run_suite(parsed.sizes, parsed.kernels, parsed.filters,
+                        parsed.repeat, not parsed.no_memory)
+    if parsed.output:
+        write_results(results, parsed.output, lab.backend)
+    if parsed.compare and compare_results(results, parsed.compare, parsed.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['suite', 'crossover'], nargs='?', default='suite')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024, 4096])
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 5, 9, 15, 25, 51])
+    parser.add_argument('--backend', choices=['python', 'numpy'], default='python')
+    parser.add_argument('--filters', nargs='+', choices=[name for name, _ in FILTER_BENCHMARKS])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    parser.add_argument('--threshold', type=float, default=1.1)
+    parsed = parser.parse_args()
+
+    if parsed.mode == 'crossover':
+        crossover_main(parsed)
+    else:
+        suite_main(parsed)
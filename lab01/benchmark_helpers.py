@@ -0,0 +1,84 @@
+"""
+Timing, memory and result file helpers shared by the benchmarks of the labs
+(lab01/benchmark.py and lab02/benchmark.py). They do not import lab, so they
+can be used with either lab's module of that name.
+"""
+
+import json
+import time
+import platform
+import tracemalloc
+import subprocess
+
+
+def time_call(func, repeat=3):
+    """
+    Returns the best wall time of repeat calls to func.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(func):
+    """
+    Returns the peak number of bytes allocated by Python during a call to
+    func. (Tracing slows calls down, so this is measured apart from time.)
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def get_commit():
+    """
+    Returns the current git commit hash, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results, filename, backend):
+    """
+    Saves benchmark results to a JSON file, with the commit, backend and
+    Python version they were measured with.
+    """
+    with open(filename, 'w') as f:
+        json.dump({
+            'commit': get_commit(),
+            'backend': backend,
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }, f, indent=2)
+
+
+def compare_results(results, filename, threshold=1.1, name_width=10):
+    """
+    Compares results with those saved in a JSON file. Prints the ratio of the
+    new to the old time of each benchmark run in both (with the names padded
+    to name_width), and returns the list of (name, size, n, ratio) slower
+    than threshold times the old time.
+    """
+    with open(filename) as f:
+        old = {(r['name'], r['size'], r['n']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        key = (result['name'], result['size'], result['n'])
+        if key not in old:
+            continue
+        ratio = result['seconds'] / old[key]['seconds']
+        print('%-*s %6d %4s %6.2fx%s' % (name_width, key[0], key[1], key[2] or '-', ratio,
+                                         '  REGRESSION' if ratio > threshold else ''))
+        if ratio > threshold:
+            regressions.append((*key, ratio))
+    return regressions
@@ -1,13 +1,54 @@
 #!/usr/bin/env python3
 
 import math
+import functools
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from PIL import Image as Image
 
-# NO ADDITIONAL IMPORTS ALLOWED!
+try:
+    import numpy as np
+except ImportError:  # the pure Python backend does not need it
+    np = None
 
 
-def get_pixel(image, x, y):
+BOUNDARIES = ('extend', 'zero', 'wrap', 'reflect')
+
+
+def get_boundary_index(i, size, boundary='extend'):
+    """
+    Maps a (possibly out of range) index along an axis of the given size to
+    the index of the pixel read there, according to the boundary mode:
+    - 'extend': repeat the edge pixel (... a a | a b c | c c ...)
+    - 'zero': there is no pixel, None is returned (reads as 0)
+    - 'wrap': tile the image (... b c | a b c | a b ...)
+    - 'reflect': mirror about the edge pixel (... c b | a b c | b a ...)
+    """
+    if 0 <= i < size:
+        return i
+    if boundary == 'extend':
+        return 0 if i < 0 else size - 1
+    if boundary == 'zero':
+        return None
+    if boundary == 'wrap':
+        return i % size
+    if boundary == 'reflect':
+        if size == 1:
+            return 0
+        i %= 2 * (size - 1)
+        return i if i < size else 2 * (size - 1) - i
+    raise ValueError('Unknown boundary: %r' % boundary)
+
+
+def get_pixel(image, x, y, boundary='extend'):
+    if boundary != 'extend':
+        x = get_boundary_index(x, image['width'], boundary)
+        y = get_boundary_index(y, image['height'], boundary)
+        if x is None or y is None:
+            return 0
+        return image['pixels'][x + y*image['width']]
     # Adjust edge effects
     x = 0 if x < 0 else x
     x = image['width'] - 1 if x >= image['width'] else x
@@ -20,22 +61,289 @@ def set_pixel(image, x, y, c):
     image['pixels'][x + y*image['width']] = c
 
 
-def apply_per_pixel(image, func):
-    result = {
+# COMPACT IMAGES
+#
+# Besides a list, the 'pixels' of an image may be an array('B') (valid 8-bit
+# images), an array('d') (unrounded filter output) or a memoryview of either.
+# Filters given a compact image return compact images, so no per-pixel Python
+# objects are allocated.
+
+def is_compact(image):
+    """
+    Returns True if the image's pixels are stored in an array buffer.
+    """
+    return isinstance(image['pixels'], (array, memoryview))
+
+def get_typecode(pixels):
+    """
+    Returns the array typecode of an array or memoryview of pixels.
+    """
+    return pixels.format if isinstance(pixels, memoryview) else pixels.typecode
+
+def get_result_typecode(values):
+    """
+    Returns the array typecode compact images store the given pixel values
+    with: 'B' if they are all ints in [0, 255], else 'd'.
+    """
+    if all(isinstance(c, int) and 0 <= c <= 255 for c in values):
+        return 'B'
+    return 'd'
+
+def make_buffer(image, size, typecode='d'):
+    """
+    Returns a zero-filled pixel buffer of the given size, stored the same way
+    as the image's pixels: an array of the given typecode for compact images,
+    else a list.
+    """
+    if is_compact(image):
+        return array(typecode, bytes(array(typecode).itemsize * size))
+    return [0] * size
+
+def make_pixels(image, values, typecode='d'):
+    """
+    Returns the given pixel values stored the same way as the image's pixels.
+    """
+    if is_compact(image):
+        return array(typecode, values)
+    return list(values)
+
+def compact_image(image):
+    """
+    Returns a copy of the image with its pixels in an array: array('B') if they
+    are all integers in [0, 255], else array('d').
+    """
+    pixels = image['pixels']
+    if is_compact(image):
+        pixels = array(get_typecode(pixels), pixels)
+    else:
+        pixels = array(get_result_typecode(pixels), pixels)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+def expand_image(image):
+    """
+    Returns a copy of the image with its pixels in a list, the format used by
+    the 6.009 tests.
+    """
+    return {
         'height': image['height'],
         'width': image['width'],
-        'pixels': [0] * image['height'] * image['width'],
+        'pixels': list(image['pixels']),
+    }
+
+def image_rows(image, start, stop):
+    """
+    Returns the image made of rows start..stop-1 of the given image. For compact
+    images the pixels are a memoryview into the original buffer (no copy).
+    """
+    width = image['width']
+    pixels = image['pixels']
+    if isinstance(pixels, array):
+        pixels = memoryview(pixels)
+    return {
+        'height': stop - start,
+        'width': width,
+        'pixels': pixels[start * width:stop * width],
     }
-    for x in range(image['width']):
-        for y in range(image['height']):
-            color = get_pixel(image, x, y)
-            newcolor = func(color)
-            set_pixel(result, x, y, newcolor)
+
+
+# PARALLEL FILTERS
+
+def filter_strip(filt, args, n, source_name, source_typecode, target_name,
+                 target_typecode, width, height, start, stop):
+    """
+    Worker for parallel_filter: applies filt(image, *args) to rows
+    start..stop-1 of the image in the shared memory block source_name, reading
+    the extra rows the nxn windows of those rows need, and writes the
+    resulting rows into the shared memory block target_name.
+
+    The same number of extra rows is read on both sides, since 'reflect'
+    mirrors the rows below the top edge of the image (and above its bottom
+    edge) into the windows that cross it.
+    """
+    halo = max(n // 2, n - 1 - n // 2)
+    top = max(0, start - halo)
+    bottom = min(height, stop + halo)
+    source = shared_memory.SharedMemory(name=source_name)
+    target = shared_memory.SharedMemory(name=target_name)
+    try:
+        with source.buf.cast(source_typecode) as view:
+            band = {
+                'height': bottom - top,
+                'width': width,
+                'pixels': view[top * width:bottom * width].tolist(),
+            }
+        result = filt(band, *args)['pixels']
+        offset = (start - top) * width
+        rows = array(target_typecode, result[offset:offset + (stop - start) * width])
+        with target.buf.cast(target_typecode) as view:
+            view[start * width:stop * width] = rows
+    finally:
+        source.close()
+        target.close()
+
+def use_workers(workers, boundary='extend'):
+    """
+    Returns True if a filter should run in parallel with the given workers.
+    Strips only see their neighbors' rows, so 'wrap' (which reads rows from
+    the opposite edge) always runs serially.
+    """
+    return workers is not None and workers > 1 and boundary != 'wrap'
+
+def parallel_filter(image, filt, args, n, workers, typecode):
+    """
+    Computes filt(image, *args) for a filter whose output pixels depend only on
+    the nxn window around them (with edge extension), by splitting the image
+    into one horizontal strip per worker process. Each strip is filtered with
+    the rows of its neighbors its windows overlap, so the stitched result is
+    the same as filtering the whole image.
+
+    The pixels are passed through shared memory; typecode is the array type
+    the results are stored with (and returned with, for compact images).
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    size = width * height
+    if is_compact(image):
+        source_typecode = get_typecode(pixels)
+    elif all(isinstance(pixel, int) for pixel in pixels):
+        source_typecode = 'q'
+    else:
+        source_typecode = 'd'
+    source_bytes = array(source_typecode).itemsize * size
+    target_bytes = array(typecode).itemsize * size
+    source = shared_memory.SharedMemory(create=True, size=max(source_bytes, 1))
+    target = shared_memory.SharedMemory(create=True, size=max(target_bytes, 1))
+    try:
+        with source.buf[:source_bytes].cast(source_typecode) as view:
+            view[:] = pixels if is_compact(image) else array(source_typecode, pixels)
+
+        strips = min(workers, height)
+        rows = -(-height // strips)
+        with ProcessPoolExecutor(max_workers=strips) as executor:
+            futures = [executor.submit(filter_strip, filt, args, n,
+                                       source.name, source_typecode,
+                                       target.name, typecode, width, height,
+                                       start, min(start + rows, height))
+                       for start in range(0, height, rows)]
+            for future in futures:
+                future.result()
+
+        if is_compact(image):
+            result_pixels = array(typecode)
+            result_pixels.frombytes(target.buf[:target_bytes])
+        else:
+            with target.buf[:target_bytes].cast(typecode) as view:
+                result_pixels = view.tolist()
+    finally:
+        source.close()
+        source.unlink()
+        target.close()
+        target.unlink()
+    return {'height': height, 'width': width, 'pixels': result_pixels}
+
+
+# POINT OPERATIONS
+#
+# A point operation maps each pixel value on its own. On 8-bit pixels (ints in
+# [0, 255]) it is given by a lookup table (LUT) of its 256 outputs, computed
+# once; the image is then mapped through the table in row-major order (with
+# bytes.translate for array('B') pixels) instead of calling a function per
+# pixel. Tables compose, so a chain of point operations is one lookup.
+
+def is_8bit(image):
+    """
+    Returns True if every pixel of the image is an int in [0, 255].
+    """
+    pixels = image['pixels']
+    if is_compact(image) and get_typecode(pixels) == 'B':
+        return True
+    return all(isinstance(pixel, int) and 0 <= pixel <= 255 for pixel in pixels)
+
+def get_lut(func):
+    """
+    Returns the lookup table of func: the list of func(c) for c in 0..255.
+    """
+    return [func(c) for c in range(256)]
+
+def get_image_lut(image, func):
+    """
+    Returns a lookup table of func for the given 8-bit image, calling func
+    only on the values the image contains (in increasing order); the other
+    entries, which are never looked up, are 0.
+    """
+    outputs = {c: func(c) for c in sorted(set(image['pixels']))}
+    return [outputs.get(c, 0) for c in range(256)]
+
+def compose_luts(*luts):
+    """
+    Returns the lookup table applying the given tables in order (the first
+    one first). All but the last must map to 8-bit values.
+    """
+    result = list(range(256))
+    for lut in luts:
+        if not all(isinstance(c, int) and 0 <= c <= 255 for c in result):
+            raise ValueError('Only 8-bit values can be looked up in a LUT')
+        result = [lut[c] for c in result]
     return result
 
+def apply_lut(image, lut):
+    """
+    Returns a new image with each pixel c of the given 8-bit image replaced by
+    lut[c], stored the same way as the image's pixels: compact results are
+    array('B') if the table maps to 8-bit values, else array('d').
+    """
+    pixels = image['pixels']
+    if is_compact(image):
+        if get_result_typecode(lut) == 'B':
+            new_pixels = array('B', bytes(pixels).translate(bytes(lut)))
+        else:
+            new_pixels = array('d', [lut[c] for c in pixels])
+    else:
+        new_pixels = [lut[c] for c in pixels]
+    return {'height': image['height'], 'width': image['width'], 'pixels': new_pixels}
+
+def apply_per_pixel(image, func, use_lut=True):
+    """
+    Returns a new image with func applied to each pixel, stored the same way as
+    the image's pixels (see apply_lut). 8-bit images are mapped through
+    get_image_lut(image, func) unless use_lut is False (func is then called
+    once per pixel, in row-major order).
+    """
+    if use_lut and is_8bit(image):
+        return apply_lut(image, get_image_lut(image, func))
+    new_pixels = [func(c) for c in image['pixels']]
+    if is_compact(image):
+        new_pixels = array(get_result_typecode(new_pixels), new_pixels)
+    return {'height': image['height'], 'width': image['width'], 'pixels': new_pixels}
+
+
+INVERTED_LUT = get_lut(lambda c: 255-c)
 
 def inverted(image):
-    return apply_per_pixel(image, lambda c: 255-c)
+    if backend == 'numpy':
+        return numpy_inverted(image)
+    if is_8bit(image):
+        return apply_lut(image, INVERTED_LUT)
+    return apply_per_pixel(image, lambda c: 255-c, use_lut=False)
+
+
+# The products .299 * r, .587 * g and .114 * b of the greyscale conversion,
+# for each 8-bit value. Adding them in the same order as the formula gives
+# the same floats, so the same rounded greyscale values.
+LUMINANCE_LUTS = (get_lut(lambda c: .299*c), get_lut(lambda c: .587*c),
+                  get_lut(lambda c: .114*c))
+
+def luminance(red, green, blue):
+    """
+    Returns the list of greyscale values round(.299*r + .587*g + .114*b) of
+    the given red, green and blue channels (bytes, array('B') planes or lists
+    of 8-bit values), looking the products up in LUMINANCE_LUTS.
+    """
+    if backend == 'numpy':
+        return numpy_luminance(red, green, blue)
+    lut_r, lut_g, lut_b = LUMINANCE_LUTS
+    return [round(lut_r[r] + lut_g[g] + lut_b[b]) for r, g, b in zip(red, green, blue)]
 
 
 # HELPER FUNCTIONS
@@ -63,7 +371,250 @@ def get_correlation(image, x, y, kernel):
             newcolor += color * kernel_value
     return newcolor
 
-def correlate(image, kernel):
+def divide_tap(value, pivot):
+    """
+    Returns value / pivot, keeping exact integer quotients as ints so integer
+    kernels still produce integer correlations.
+    """
+    if isinstance(value, int) and isinstance(pivot, int) and value % pivot == 0:
+        return value // pivot
+    return value / pivot
+
+def is_dyadic(value):
+    """
+    Returns True if value is an integer or a short power-of-two fraction (such
+    as 0.5 or 0.125), so products and sums of it with pixels are exact floats
+    and the order of the additions cannot change the result. (Every float is
+    a binary fraction, so the denominator and numerator are bounded.)
+    """
+    numerator, denominator = float(value).as_integer_ratio()
+    return denominator <= 2 ** 16 and abs(numerator) < 2 ** 20
+
+def get_separable_factors(kernel):
+    """
+    Returns a (column, row) pair of 1D kernels whose outer product is the given
+    kernel, i.e. kernel[x, y] == column[y] * row[x], or None if the kernel is
+    not separable (rank 1).
+    """
+    n = kernel['size']
+    flat_kernel = kernel['flat_kernel']
+    nonzero = [i for i in range(n * n) if flat_kernel[i] != 0]
+    if not nonzero:
+        return None
+    # Factor around the smallest tap so integer kernels tend to have integer
+    # factors (e.g. [1, 2, 1] rather than [0.5, 1, 0.5])
+    pivot = min(nonzero, key=lambda i: abs(flat_kernel[i]))
+    x_pivot, y_pivot = pivot % n, pivot // n
+    column = [get_kernel(kernel, x_pivot, y) for y in range(n)]
+    row = [divide_tap(get_kernel(kernel, x, y_pivot), flat_kernel[pivot])
+           for x in range(n)]
+    if (all(isinstance(value, int) for value in flat_kernel)
+            and not all(isinstance(value, int) for value in row)):
+        # Integer kernels must give integer results, so keep the direct path
+        return None
+    for y in range(n):
+        for x in range(n):
+            if not math.isclose(column[y] * row[x], get_kernel(kernel, x, y),
+                                rel_tol=1e-9, abs_tol=1e-12):
+                return None
+    return column, row
+
+def get_axis_taps(weights, size, boundary='extend', stride=1):
+    """
+    Returns, for each position along an axis of the given size, the list of
+    (weight, index * stride) pairs of the 1D kernel taps read there, with
+    indices mapped by get_boundary_index. Taps reading outside the image in
+    'zero' mode are left out.
+    """
+    mid = len(weights) // 2
+    taps = []
+    for i in range(size):
+        position_taps = []
+        for k, weight in enumerate(weights):
+            index = get_boundary_index(i - mid + k, size, boundary)
+            if index is not None:
+                position_taps.append((weight, index * stride))
+        taps.append(position_taps)
+    return taps
+
+def correlate_separable(image, column, row, boundary='extend', clip=False):
+    """
+    Computes the correlation of the image with the separable kernel given by
+    its column and row factors (see get_separable_factors) as a horizontal
+    pass followed by a vertical pass, i.e. 2n taps per pixel instead of n**2.
+
+    Every boundary mode is separable too: mapping x in the first pass and y in
+    the second reads exactly the pixels get_pixel would.
+
+    If clip is True, the second pass rounds and clips each pixel as it is
+    written (see correlate).
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+
+    # Source columns/rows for each output column/row, computed once
+    x_taps = get_axis_taps(row, width, boundary)
+    y_taps = get_axis_taps(column, height, boundary, width)
+
+    horizontal = make_buffer(image, height * width)
+    for y in range(height):
+        start = y * width
+        for x in range(width):
+            newcolor = 0
+            for weight, x_image in x_taps[x]:
+                newcolor += pixels[start + x_image] * weight
+            horizontal[start + x] = newcolor
+
+    result = {
+        'height': height,
+        'width': width,
+        'pixels': make_buffer(image, height * width, 'B' if clip else 'd'),
+    }
+    result_pixels = result['pixels']
+    for y in range(height):
+        start = y * width
+        rows = y_taps[y]
+        for x in range(width):
+            newcolor = 0
+            for weight, row_start in rows:
+                newcolor += horizontal[row_start + x] * weight
+            if clip:
+                newcolor = 0 if newcolor < 0 else (255 if newcolor > 255 else round(newcolor))
+            result_pixels[start + x] = newcolor
+    return result
+
+def compile_kernel(kernel):
+    """
+    Returns a function that correlates an image with the given kernel,
+    specialized for its taps:
+    - zero taps are skipped,
+    - taps with the same weight are summed and multiplied once,
+    - pixels whose window lies inside the image read their taps at precomputed
+      flat offsets; only the border pixels go through get_pixel's boundary
+      handling (the function takes the boundary mode as a second argument).
+
+    The function's clip argument rounds and clips each pixel as it is written
+    (see correlate).
+
+    Compiled kernels are cached by the kernel contents.
+    """
+    flat_kernel = tuple(kernel['flat_kernel'])
+    # Types are part of the key so that e.g. [1, ...] and [1.0, ...] (equal
+    # as tuples) still produce ints and floats respectively
+    return compile_flat_kernel(kernel['size'], flat_kernel,
+                               tuple(type(k) for k in flat_kernel))
+
+@functools.lru_cache(maxsize=128)
+def compile_flat_kernel(n, flat_kernel, types):
+    """
+    Compiles the kernel of size n with the given taps (see compile_kernel).
+    """
+    mid = n // 2
+    groups = {}
+    for i, weight in enumerate(flat_kernel):
+        if weight:
+            groups.setdefault(weight, []).append((i % n - mid, i // n - mid))
+    groups = list(groups.items())
+
+    def correlate_compiled(image, boundary='extend', clip=False):
+        width = image['width']
+        height = image['height']
+        pixels = image['pixels']
+        result = {
+            'height': height,
+            'width': width,
+            'pixels': make_buffer(image, height * width, 'B' if clip else 'd'),
+        }
+        result_pixels = result['pixels']
+
+        # Pixels in columns/rows low..high-1 have their whole window inside
+        low = mid
+        high_x = width - (n - 1 - mid)
+        high_y = height - (n - 1 - mid)
+        offset_groups = [(weight, [dx + dy * width for dx, dy in taps])
+                         for weight, taps in groups]
+        border = list(range(min(low, width))) + list(range(max(high_x, low), width))
+
+        for y in range(height):
+            start = y * width
+            if low <= y < high_y:
+                for i in range(start + low, start + high_x):
+                    newcolor = 0
+                    for weight, offsets in offset_groups:
+                        total = 0
+                        for offset in offsets:
+                            total += pixels[i + offset]
+                        newcolor += weight * total
+                    if clip:
+                        newcolor = 0 if newcolor < 0 else (255 if newcolor > 255
+                                                           else round(newcolor))
+                    result_pixels[i] = newcolor
+                columns = border
+            else:
+                columns = range(width)
+            for x in columns:
+                newcolor = 0
+                for weight, taps in groups:
+                    total = 0
+                    for dx, dy in taps:
+                        total += get_pixel(image, x + dx, y + dy, boundary)
+                    newcolor += weight * total
+                if clip:
+                    newcolor = 0 if newcolor < 0 else (255 if newcolor > 255
+                                                       else round(newcolor))
+                result_pixels[start + x] = newcolor
+        return result
+
+    return correlate_compiled
+
+CORRELATION_METHODS = ('auto', 'direct', 'separable', 'fft')
+
+# Measured cost of each correlation method (see benchmark.py), in seconds:
+# per pixel per tap for 'direct' and 'separable', per element * log2(elements)
+# of the padded image for 'fft', plus a fixed cost per call.
+CORRELATION_COSTS = {
+    'python': {
+        'direct': (2e-7, 0),
+        'separable': (1.1e-7, 0),
+        'fft': (1.2e-8, 1.5e-4),
+    },
+    'numpy': {
+        'direct': (2.8e-9, 5e-5),
+        'fft': (8e-9, 1e-4),
+    },
+}
+
+# Smallest kernel for which 'auto' considers 'fft'. FFT results differ from
+# the exact sums by rounding errors, so 'auto' only uses it with the numpy
+# backend, for kernels large enough to make it pay off; the python backend
+# only uses it when asked for with method='fft'.
+FFT_MIN_KERNEL_SIZE = 9
+
+def choose_correlation_method(width, height, kernel):
+    """
+    Returns the cheapest method ('direct', 'separable' or 'fft') to correlate
+    an image of the given size with the kernel under the current backend,
+    according to CORRELATION_COSTS. 'fft' is only considered with the numpy
+    backend, for kernels of at least FFT_MIN_KERNEL_SIZE, and 'separable'
+    only when its factors are dyadic (see is_dyadic), so the choice never
+    changes the result.
+    """
+    n = kernel['size']
+    pixels = width * height
+    costs = CORRELATION_COSTS[backend]
+    taps = sum(1 for k in kernel['flat_kernel'] if k)
+    estimates = {'direct': costs['direct'][0] * pixels * taps + costs['direct'][1]}
+    factors = get_separable_factors(kernel) if 'separable' in costs and n > 1 else None
+    if factors is not None and all(is_dyadic(v) for factor in factors for v in factor):
+        estimates['separable'] = costs['separable'][0] * pixels * 2 * n + costs['separable'][1]
+    if backend == 'numpy' and n >= FFT_MIN_KERNEL_SIZE:
+        padded = (width + n - 1) * (height + n - 1)
+        estimates['fft'] = costs['fft'][0] * padded * math.log2(padded + 1) + costs['fft'][1]
+    return min(estimates, key=estimates.get)
+
+def correlate(image, kernel, workers=None, boundary='extend', method='auto',
+              clip=False):
     """
     Compute the result of correlating the given image with the given kernel.
 
@@ -78,17 +629,55 @@ def correlate(image, kernel):
     The kernel is a dictionary similar to the image dictionary.
     kernel = {'size': n, flat_kernel: []}
     The kernel['flat_kernel'] stores the nxn kernel matrix in row-major order.
+
+    Separable kernels (e.g. box blurs and the Sobel operators) are computed as
+    two 1D passes, others with a kernel specialized by compile_kernel.
+
+    Pixels outside the image are read according to boundary, one of
+    BOUNDARIES (see get_boundary_index); the default 'extend' repeats the edge
+    pixels.
+
+    If workers is given, the image is split into that many strips, correlated
+    in parallel processes (see parallel_filter).
+
+    method is one of CORRELATION_METHODS: 'direct' (one multiply per nonzero
+    tap), 'separable' (two 1D passes, for rank 1 kernels), 'fft' (through the
+    Fourier transform, needs NumPy) or 'auto', which picks the cheapest
+    exact method for the kernel and image size, or 'fft' for large kernels
+    with the numpy backend (see choose_correlation_method).
+
+    If clip is True, the result is rounded and clipped as by
+    round_and_clip_image, as part of the last pass of the correlation, so the
+    unrounded image is never stored (compact results are then array('B')).
     """
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [0] * image['height'] * image['width'],
-    }
-    for x in range(image['width']):
-        for y in range(image['height']):
-            newcolor = get_correlation(image, x, y, kernel)
-            set_pixel(result, x, y, newcolor)
-    return result
+    if method not in CORRELATION_METHODS:
+        raise ValueError('Unknown correlation method: %r' % method)
+    if use_workers(workers, boundary):
+        typecode = 'd'
+        if clip:
+            typecode = 'B'
+        elif (not is_compact(image)
+                and all(isinstance(k, int) for k in kernel['flat_kernel'])
+                and all(isinstance(pixel, int) for pixel in image['pixels'])):
+            typecode = 'q'
+        return parallel_filter(image, functools.partial(correlate, boundary=boundary,
+                                                        method=method, clip=clip),
+                               (kernel,), kernel['size'], workers, typecode)
+    if method == 'auto':
+        method = choose_correlation_method(image['width'], image['height'], kernel)
+
+    if method == 'fft':
+        if np is None:
+            raise ValueError('FFT correlation requires NumPy')
+        return numpy_correlate_fft(image, kernel, boundary, clip)
+    if backend == 'numpy':
+        return numpy_correlate(image, kernel, boundary, clip)
+    if method == 'separable':
+        factors = get_separable_factors(kernel)
+        if factors is None:
+            raise ValueError('Kernel is not separable')
+        return correlate_separable(image, *factors, boundary, clip)
+    return compile_kernel(kernel)(image, boundary, clip)
 
 
 def round_and_clip_image(image):
@@ -101,10 +690,95 @@ def round_and_clip_image(image):
     Any locations with values higher than 255 in the input should have value
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
+
+    Compact images get a new array('B') of pixels, since the values no longer
+    fit the type of the old buffer.
     """
+    if backend == 'numpy':
+        return numpy_round_and_clip_image(image)
     pixels = image['pixels']
-    for i, pixel in enumerate(pixels):
-        pixels[i] = 0 if pixel < 0 else (255 if pixel > 255 else round(pixel))
+    if is_compact(image):
+        image['pixels'] = array('B', round_and_clip_values(pixels))
+    else:
+        pixels[:] = round_and_clip_values(pixels)
+
+def round_and_clip_values(values):
+    """
+    Returns a list of the given values clipped to [0, 255] and rounded with
+    Python's round (half to even), computed in a single pass. values may be
+    any iterable, so a generator of filter outputs is rounded as it is
+    produced, without storing the unrounded values.
+    """
+    return [0 if value < 0 else (255 if value > 255 else round(value))
+            for value in values]
+
+def rounded_and_clipped(image):
+    """
+    Returns a new image with the pixels of the given image rounded and clipped
+    as by round_and_clip_image, which mutates the image instead. The pixels
+    are an array('B') for compact images, else a list of ints.
+    """
+    if backend == 'numpy':
+        values = numpy_round_and_clip(to_ndarray(image))
+        return from_ndarray(image, values.astype(np.int64), 'B')
+    return {
+        'height': image['height'],
+        'width': image['width'],
+        'pixels': make_pixels(image, round_and_clip_values(image['pixels']), 'B'),
+    }
+
+def box_sum(image, n, boundary='extend'):
+    """
+    Returns a new image whose pixels are the sums of the nxn neighborhood of
+    each pixel, with the same boundary handling and window placement as
+    correlate.
+
+    The sums are read from a summed-area table (integral image) of the
+    extended image, so the cost per pixel does not depend on n.
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    mid = n // 2
+
+    # Extended image columns/rows; the window of pixel (x, y) covers the
+    # extended columns x..x+n-1 and rows y..y+n-1
+    columns = [get_boundary_index(x - mid, width, boundary)
+               for x in range(width + n - 1)]
+    rows = [get_boundary_index(y - mid, height, boundary)
+            for y in range(height + n - 1)]
+
+    # table[i + j*table_width] is the sum of the extended image above and to
+    # the left of (i, j), so the first row and column are all zeros
+    table_width = width + n
+    table = make_buffer(image, table_width * (height + n))
+    for j, y in enumerate(rows):
+        if y is None:
+            extended_row = [0] * len(columns)
+        else:
+            start = y * width
+            extended_row = [0 if x is None else pixels[start + x] for x in columns]
+        above = j * table_width + 1
+        here = above + table_width
+        running = 0
+        for i, pixel in enumerate(extended_row):
+            running += pixel
+            table[here + i] = table[above + i] + running
+
+    result = {
+        'height': height,
+        'width': width,
+        'pixels': make_buffer(image, height * width),
+    }
+    result_pixels = result['pixels']
+    for y in range(height):
+        top = y * table_width
+        bottom = top + n * table_width
+        start = y * width
+        for x in range(width):
+            result_pixels[start + x] = (table[bottom + x + n] - table[top + x + n]
+                                        - table[bottom + x] + table[top + x])
+    return result
 
 # FILTERS
 
@@ -117,24 +791,34 @@ def get_boxblur(n):
         'flat_kernel': [1/n ** 2] * n ** 2
     }
 
-def blurred(image, n):
+def blurred(image, n, workers=None, boundary='extend'):
     """
     Return a new image representing the result of applying a box blur (with
     kernel size n) to the given input image.
 
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
+
+    Pixels outside the image are read according to boundary (see correlate).
+
+    If workers is given, strips of the image are blurred in that many
+    processes.
     """
-    # first, create a representation for the appropriate n-by-n kernel (you may
-    # wish to define another helper function for this)
-    boxblur = get_boxblur(n)
+    if use_workers(workers, boundary):
+        return parallel_filter(image, functools.partial(blurred, boundary=boundary),
+                               (n,), n, workers, 'B')
+    if backend == 'numpy':
+        return numpy_blurred(image, n, boundary)
 
-    # then compute the correlation of the input image with that kernel
-    result = correlate(image, boxblur)
+    # the box blur is the n-by-n box sum scaled by the kernel weight, which the
+    # summed-area table computes at the same cost for any n
+    result = box_sum(image, n, boundary)
+    area = n ** 2
 
-    # and, finally, make sure that the output is a valid image (using the
-    # helper function from above) before returning it.
-    round_and_clip_image(result)
+    # and, finally, make sure that the output is a valid image: the scaling is
+    # rounded and clipped as it is computed, so no float image is stored
+    result['pixels'] = make_pixels(image, round_and_clip_values(
+        pixel / area for pixel in result['pixels']), 'B')
 
     return result
 
@@ -150,7 +834,7 @@ def get_sharpkernel(n):
 
     return kernel
 
-def sharpened(image, n):
+def sharpened(image, n, workers=None, boundary='extend'):
     """
     Return a new image representing the result of applying an unshparp mask
     of blurred kernel size n to the given input image.
@@ -159,66 +843,380 @@ def sharpened(image, n):
 
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
-    """
-    sharpkernel = get_sharpkernel(n)
 
-    result = correlate(image, sharpkernel)
+    Pixels outside the image are read according to boundary (see correlate).
+
+    If workers is given, strips of the image are sharpened in that many
+    processes.
+    """
+    if use_workers(workers, boundary):
+        return parallel_filter(image, functools.partial(sharpened, boundary=boundary),
+                               (n,), n, workers, 'B')
+    if backend == 'numpy':
+        return numpy_sharpened(image, n, boundary)
 
-    round_and_clip_image(result)
+    # Correlating with get_sharpkernel(n) is 2I - B, with B from the box sum.
+    # The identity tap sits at flat index n**2 // 2, which is off center when
+    # n is even
+    center = n ** 2 // 2
+    dx = center % n - n // 2
+    dy = center // n - n // 2
+    if dx == 0 and dy == 0:
+        identity = image['pixels']
+    else:
+        identity = [get_pixel(image, x + dx, y + dy, boundary)
+                    for y in range(image['height'])
+                    for x in range(image['width'])]
+    result = box_sum(image, n, boundary)
+    area = n ** 2
+    result['pixels'] = make_pixels(image, round_and_clip_values(
+        2 * pixel - blur / area for pixel, blur in zip(identity, result['pixels'])), 'B')
 
     return result
 
-def edges(image):
+def edges(image, workers=None, direction=False, boundary='extend'):
     """
     Return a new image representing the result of sobel operator for edge
     detection. Both a Kx and Ky correlation is performed. Each of 3x3.
 
+    Kx, Ky, the magnitude and its rounding and clipping are fused into a single
+    pass over each 3x3 window, which writes straight into the output image.
+
+    If direction is True, returns a (magnitude, direction) pair of images,
+    where the direction image holds the unrounded gradient angles
+    math.atan2(Ky, Kx) in radians.
+
+    Pixels outside the image are read according to boundary (see correlate).
+
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
+
+    If workers is given, strips of the image are processed in that many
+    processes (the direction is always computed serially).
     """
-    kernel_x = {'size': 3, 'flat_kernel': [-1, 0, 1, -2, 0, 2, -1, 0, 1]}
-    result_x = correlate(image, kernel_x)
-    kernel_y = {'size': 3, 'flat_kernel': [-1, -2, -1, 0, 0, 0, 1, 2, 1]}
-    result_y = correlate(image, kernel_y)
+    if not image['width'] or not image['height']:
+        # No pixels, and no rows or columns for the boundary to extend
+        empty = {'height': image['height'], 'width': image['width'],
+                 'pixels': make_buffer(image, 0, 'B')}
+        if direction:
+            return empty, dict(empty, pixels=make_buffer(image, 0))
+        return empty
+    if use_workers(workers, boundary) and not direction:
+        return parallel_filter(image, functools.partial(edges, boundary=boundary),
+                               (), 3, workers, 'B')
+    if backend == 'numpy':
+        return numpy_edges(image, direction, boundary)
 
-    result = { 
-        'width': image['width'],
-        'height': image['height'],    
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    result = {
+        'height': height,
+        'width': width,
+        'pixels': make_buffer(image, height * width, 'B'),
     }
+    result_pixels = result['pixels']
+    if direction:
+        angles = {
+            'height': height,
+            'width': width,
+            'pixels': make_buffer(image, height * width),
+        }
+        angle_pixels = angles['pixels']
+
+    left = get_boundary_index(-1, width, boundary)
+    right = get_boundary_index(width, width, boundary)
+
+    def extended_row(y):
+        # Row y with its outside neighbor on each side, so that the window
+        # of pixel x spans columns x..x+2
+        y = get_boundary_index(y, height, boundary)
+        if y is None:
+            return [0] * (width + 2)
+        row = pixels[y * width:(y + 1) * width]
+        return [0 if left is None else row[left], *row,
+                0 if right is None else row[right]]
 
-    result["pixels"] = list(map(lambda x, y: math.sqrt(x**2 + y**2),
-     result_x['pixels'], result_y['pixels']))
-    
-    round_and_clip_image(result)
+    above = extended_row(-1)
+    here = extended_row(0)
+    for y in range(height):
+        below = extended_row(y + 1)
+        start = y * width
+        for x in range(width):
+            top_left = above[x]
+            top_right = above[x + 2]
+            bottom_left = below[x]
+            bottom_right = below[x + 2]
+            # Kx = [-1, 0, 1, -2, 0, 2, -1, 0, 1], Ky = [-1, -2, -1, 0, 0, 0, 1, 2, 1]
+            gx = (top_right - top_left + 2 * (here[x + 2] - here[x])
+                  + bottom_right - bottom_left)
+            gy = (bottom_left - top_left + 2 * (below[x + 1] - above[x + 1])
+                  + bottom_right - top_right)
+            magnitude = math.sqrt(gx * gx + gy * gy)
+            result_pixels[start + x] = 255 if magnitude > 255 else round(magnitude)
+            if direction:
+                angle_pixels[start + x] = math.atan2(gy, gx)
+        above, here = here, below
 
+    if direction:
+        return result, angles
+    return result
+
+# NUMPY BACKEND
+#
+# Vectorized versions of the filters above, producing the same images (same
+# storage, same values after rounding) as the reference loops.
+
+backend = 'python'
+
+def set_backend(name):
+    """
+    Selects the implementation used by the filters: 'python' for the reference
+    loops or 'numpy' for the vectorized ones. Falls back to 'python' if NumPy
+    is not installed. Returns the name of the backend now in use.
+    """
+    global backend
+    if name not in ('python', 'numpy'):
+        raise ValueError('Unknown backend: %r' % name)
+    backend = name if name == 'python' or np is not None else 'python'
+    return backend
+
+def to_ndarray(image):
+    """
+    Returns the image pixels as a height x width NumPy array. Compact pixels
+    are wrapped without copying.
+    """
+    return np.asarray(image['pixels']).reshape(image['height'], image['width'])
+
+def from_ndarray(image, values, typecode='d'):
+    """
+    Returns a new image of the same size and storage as the given one, with
+    the values of the given NumPy array as pixels.
+    """
+    if is_compact(image):
+        pixels = array(typecode, values.astype(typecode).tobytes())
+    else:
+        pixels = values.ravel().tolist()
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+NUMPY_PAD_MODES = {
+    'extend': 'edge',
+    'zero': 'constant',
+    'wrap': 'wrap',
+    'reflect': 'reflect',
+}
+
+def pad_edges(values, n, boundary='extend'):
+    """
+    Returns the array extended according to the boundary mode so that every
+    nxn window correlate would read is in bounds: padded[y:y+n, x:x+n] is the
+    window of pixel (x, y).
+    """
+    if boundary not in NUMPY_PAD_MODES:
+        raise ValueError('Unknown boundary: %r' % boundary)
+    mid = n // 2
+    return np.pad(values, ((mid, n - 1 - mid), (mid, n - 1 - mid)),
+                  mode=NUMPY_PAD_MODES[boundary])
+
+def numpy_round_and_clip(values):
+    """
+    Returns the array clipped to [0, 255] and rounded half to even, like
+    Python's round.
+    """
+    return np.rint(np.clip(values, 0, 255))
+
+def numpy_inverted(image):
+    values = 255 - to_ndarray(image)
+    return from_ndarray(image, values, get_typecode(image['pixels'])
+                        if is_compact(image) else 'd')
+
+def numpy_luminance(red, green, blue):
+    """
+    Computes luminance with NumPy, indexing arrays of LUMINANCE_LUTS with the
+    channels. np.rint rounds halves to even, like round.
+    """
+    values = 0
+    for lut, channel in zip(LUMINANCE_LUTS, (red, green, blue)):
+        if isinstance(channel, (bytes, bytearray, array)):
+            channel = np.frombuffer(channel, dtype=np.uint8)
+        values = values + np.array(lut)[np.asarray(channel, dtype=np.intp)]
+    return np.rint(values).astype(np.int64).tolist()
+
+
+def numpy_correlate(image, kernel, boundary='extend', clip=False):
+    n = kernel['size']
+    height, width = image['height'], image['width']
+    values = to_ndarray(image)
+    flat_kernel = kernel['flat_kernel']
+    # Integer kernels on integer images give integers, as in the reference
+    if values.dtype.kind in 'iub' and all(isinstance(k, int) for k in flat_kernel):
+        values = values.astype(np.int64)
+    else:
+        values = values.astype(np.float64)
+    padded = pad_edges(values, n, boundary)
+    result = np.zeros_like(values)
+    for i, weight in enumerate(flat_kernel):
+        if weight:
+            x_kernel, y_kernel = i % n, i // n
+            result += weight * padded[y_kernel:y_kernel + height,
+                                      x_kernel:x_kernel + width]
+    if clip:
+        return from_ndarray(image, numpy_round_and_clip(result).astype(np.int64), 'B')
+    return from_ndarray(image, result)
+
+def fast_fft_length(n):
+    """
+    Returns the smallest length >= n whose only prime factors are 2, 3 and 5,
+    for which FFTs are fastest.
+    """
+    while True:
+        m = n
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+def numpy_correlate_fft(image, kernel, boundary='extend', clip=False):
+    """
+    Correlates the image with the kernel by multiplying their Fourier
+    transforms, in O(log(size)) per pixel for any kernel size.
+
+    The image is padded according to boundary first (and then with zeros up to
+    a fast FFT size), so the circular convolution of the transforms never
+    wraps into the part that is kept.
+    Integer kernels on integer images give integer results, as in the other
+    methods.
+    """
+    n = kernel['size']
+    height, width = image['height'], image['width']
+    values = to_ndarray(image)
+    flat_kernel = kernel['flat_kernel']
+    padded = pad_edges(values.astype(np.float64), n, boundary)
+    # Correlating is convolving with the flipped kernel
+    flipped = np.array(flat_kernel, dtype=np.float64).reshape(n, n)[::-1, ::-1]
+    shape = tuple(fast_fft_length(length) for length in padded.shape)
+    spectrum = np.fft.rfft2(padded, shape) * np.fft.rfft2(flipped, shape)
+    result = np.fft.irfft2(spectrum, shape)[n - 1:n - 1 + height,
+                                            n - 1:n - 1 + width]
+    if values.dtype.kind in 'iub' and all(isinstance(k, int) for k in flat_kernel):
+        result = np.rint(result).astype(np.int64)
+    if clip:
+        return from_ndarray(image, numpy_round_and_clip(result).astype(np.int64), 'B')
+    return from_ndarray(image, result)
+
+def numpy_round_and_clip_image(image):
+    values = numpy_round_and_clip(to_ndarray(image))
+    if is_compact(image):
+        image['pixels'] = array('B', values.astype(np.uint8).tobytes())
+    else:
+        image['pixels'][:] = values.astype(np.int64).ravel().tolist()
+
+def numpy_box_sum(values, n, boundary='extend'):
+    """
+    Returns the nxn box sums of the (extended) array, read from its
+    summed-area table.
+    """
+    height, width = values.shape
+    table = np.zeros((height + n, width + n), dtype=values.dtype)
+    table[1:, 1:] = pad_edges(values, n, boundary).cumsum(0).cumsum(1)
+    return (table[n:, n:] - table[:height, n:]
+            - table[n:, :width] + table[:height, :width])
+
+def numpy_blurred(image, n, boundary='extend'):
+    values = to_ndarray(image)
+    values = values.astype(np.int64 if values.dtype.kind in 'iub' else np.float64)
+    result = numpy_box_sum(values, n, boundary) / n ** 2
+    return from_ndarray(image, numpy_round_and_clip(result).astype(np.int64), 'B')
+
+def numpy_sharpened(image, n, boundary='extend'):
+    height, width = image['height'], image['width']
+    values = to_ndarray(image)
+    values = values.astype(np.int64 if values.dtype.kind in 'iub' else np.float64)
+    # The identity tap of get_sharpkernel(n), off center when n is even
+    center = n ** 2 // 2
+    identity = pad_edges(values, n, boundary)[center // n:center // n + height,
+                                              center % n:center % n + width]
+    result = 2 * identity - numpy_box_sum(values, n, boundary) / n ** 2
+    return from_ndarray(image, numpy_round_and_clip(result).astype(np.int64), 'B')
+
+def numpy_edges(image, direction=False, boundary='extend'):
+    height, width = image['height'], image['width']
+    padded = pad_edges(to_ndarray(image).astype(np.float64), 3, boundary)
+    def window(x, y):
+        return padded[y:y + height, x:x + width]
+    result_x = (window(2, 0) - window(0, 0) + 2 * (window(2, 1) - window(0, 1))
+                + window(2, 2) - window(0, 2))
+    result_y = (window(0, 2) - window(0, 0) + 2 * (window(1, 2) - window(1, 0))
+                + window(2, 2) - window(2, 0))
+    result = numpy_round_and_clip(np.hypot(result_x, result_y))
+    result = from_ndarray(image, result.astype(np.int64), 'B')
+    if direction:
+        return result, from_ndarray(image, np.arctan2(result_y, result_x))
     return result
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
-def load_image(filename):
+def load_image(filename, compact=False):
     """
     Loads an image from the given file and returns a dictionary
     representing that image.  This also performs conversion to greyscale.
 
+    If compact is True, the pixels are returned in an array('B') copied
+    straight from PIL's buffer (see COMPACT IMAGES).
+
     Invoked as, for example:
        i = load_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
-        elif img.mode == 'L':
-            pixels = list(img_data)
-        else:
-            raise ValueError('Unsupported image mode: %r' % img.mode)
+        pixels = get_greyscale_pixels(img, compact)
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
 
+def get_greyscale_pixels(img, compact=False):
+    """
+    Returns the pixels of the given PIL image as a list of greyscale values,
+    or an array('B') if compact is True, read from the raw bytes of its
+    bands rather than pixel by pixel.
+    """
+    if img.mode.startswith('RGB'):
+        red, green, blue = (band.tobytes() for band in img.split()[:3])
+        pixels = luminance(red, green, blue)
+        return array('B', pixels) if compact else pixels
+    if img.mode == 'LA':
+        data = img.split()[0].tobytes()
+    elif img.mode == 'L':
+        data = img.tobytes()
+    else:
+        raise ValueError('Unsupported image mode: %r' % img.mode)
+    return array('B', data) if compact else list(data)
+
+
+def make_pil_image(image):
+    """
+    Returns a PIL image ('L' mode) of the given greyscale image. Compact 8-bit
+    pixels are shared with it rather than copied; lists of 8-bit ints are
+    copied as one bytes object. Other pixels (e.g. array('d') filter output)
+    are converted by PIL value by value.
+    """
+    size = (image['width'], image['height'])
+    pixels = image['pixels']
+    if is_compact(image):
+        if get_typecode(pixels) == 'B':
+            return Image.frombuffer('L', size, pixels, 'raw', 'L', 0, 1)
+    else:
+        try:
+            return Image.frombytes('L', size, bytes(pixels))
+        except (TypeError, ValueError):  # not all 8-bit ints
+            pass
+    out = Image.new(mode='L', size=size)
+    out.putdata(pixels)
+    return out
+
+
 def save_image(image, filename, mode='PNG'):
     """
     Saves the given image to disk or to a file-like object.  If filename is
@@ -226,8 +1224,7 @@ def save_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = make_pil_image(image)
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -235,6 +1232,170 @@ def save_image(image, filename, mode='PNG'):
     out.close()
 
 
+# STREAMING FILTERS
+#
+# Images too large to hold in memory are filtered a band of rows at a time.
+# Rows are bytes objects (width bytes for 'L', 3 * width for 'RGB'). Binary
+# netpbm files (.pgm/.ppm) are read and written incrementally; other formats
+# go through PIL, which decodes (or encodes) the whole file at once, but only
+# a band of rows is ever held as Python pixels.
+
+NETPBM_EXTENSIONS = ('.pgm', '.ppm', '.pnm')
+
+
+def read_netpbm_header(handle):
+    """
+    Reads the header of a binary netpbm file, leaving the handle at the start
+    of the raster. Returns (magic, width, height, maxval).
+    """
+    tokens = []
+    while len(tokens) < 4:
+        char = handle.read(1)
+        if not char:
+            raise ValueError('Truncated netpbm header')
+        if char == b'#':
+            handle.readline()
+        elif char.isspace():
+            continue
+        else:
+            token = char
+            while True:
+                char = handle.read(1)
+                if not char or char.isspace():
+                    break
+                token += char
+            tokens.append(token)
+    magic, width, height, maxval = tokens
+    return magic, int(width), int(height), int(maxval)
+
+
+def greyscale_row(row):
+    """
+    Converts a row of RGB bytes to greyscale bytes, as load_image does.
+    """
+    return bytes(luminance(row[0::3], row[1::3], row[2::3]))
+
+
+def read_rows(filename, mode='L'):
+    """
+    Returns (width, height, rows) for the given image file, where rows is an
+    iterator over its rows as bytes in the given mode ('L' or 'RGB'). 'L'
+    performs the same greyscale conversion as load_image.
+    """
+    if filename.lower().endswith(NETPBM_EXTENSIONS):
+        handle = open(filename, 'rb')
+        magic, width, height, maxval = read_netpbm_header(handle)
+        if maxval < 256 and (magic, mode) in ((b'P5', 'L'), (b'P6', 'RGB'), (b'P6', 'L')):
+            def netpbm_rows():
+                with handle:
+                    row_bytes = width * (1 if magic == b'P5' else 3)
+                    for _ in range(height):
+                        row = handle.read(row_bytes)
+                        yield row if magic == b'P5' or mode == 'RGB' else greyscale_row(row)
+            return width, height, netpbm_rows()
+        handle.close()
+
+    img = Image.open(filename)
+    width, height = img.size
+
+    def pil_rows(band=64):
+        with img:
+            for start in range(0, height, band):
+                stop = min(start + band, height)
+                region = img.crop((0, start, width, stop))
+                if mode == 'RGB':
+                    data = region.convert('RGB').tobytes()
+                else:
+                    data = get_greyscale_pixels(region, compact=True).tobytes()
+                row_bytes = len(data) // (stop - start)
+                for y in range(stop - start):
+                    yield data[y * row_bytes:(y + 1) * row_bytes]
+    return width, height, pil_rows()
+
+
+def write_rows(filename, width, height, rows, mode='L'):
+    """
+    Writes the given iterable of rows (bytes in the given mode, 'L' or 'RGB')
+    to an image file, whose type is inferred from its name.
+    """
+    if filename.lower().endswith(NETPBM_EXTENSIONS):
+        with open(filename, 'wb') as handle:
+            magic = 'P5' if mode == 'L' else 'P6'
+            handle.write(('%s\n%d %d\n255\n' % (magic, width, height)).encode())
+            for row in rows:
+                handle.write(row)
+        return
+
+    out = Image.new(mode=mode, size=(width, height))
+    for y, row in enumerate(rows):
+        out.paste(Image.frombytes(mode, (width, 1), bytes(row)), (0, y))
+    out.save(filename)
+    out.close()
+
+
+def make_band_image(data, width, height):
+    """
+    Returns the compact greyscale image for a band of greyscale rows.
+    """
+    return {'height': height, 'width': width, 'pixels': array('B', data)}
+
+
+def get_band_bytes(image):
+    """
+    Returns the pixels of a (filtered) greyscale image as bytes.
+    """
+    pixels = image['pixels']
+    return pixels.tobytes() if isinstance(pixels, array) else bytes(pixels)
+
+
+def filter_rows(rows, width, height, filt, n, band=64,
+                make_image=make_band_image, get_bytes=get_band_bytes):
+    """
+    Applies filt, a filter whose output pixels depend only on the nxn window
+    around them (with edge extension), to an image given as an iterator over
+    its rows, and yields the rows of the result.
+
+    The image is filtered band rows at a time, each band together with the
+    rows of its neighbors its windows overlap (as in parallel_filter), so at
+    most band + n - 1 rows are held at once and the result is the same as
+    filtering the whole image. make_image builds an image from the bytes of
+    some rows and get_bytes returns the bytes of a filtered image.
+    """
+    mid = n // 2
+    rows = iter(rows)
+    window = []  # rows first..first+len(window)-1 of the image
+    first = 0
+    for start in range(0, height, band):
+        stop = min(start + band, height)
+        top = max(0, start - mid)
+        bottom = min(height, stop + n - 1 - mid)
+        del window[:top - first]
+        first = top
+        while first + len(window) < bottom:
+            window.append(next(rows))
+
+        result = get_bytes(filt(make_image(b''.join(window), width, bottom - top)))
+        row_bytes = len(result) // (bottom - top)
+        offset = (start - top) * row_bytes
+        for y in range(stop - start):
+            yield result[offset + y * row_bytes:offset + (y + 1) * row_bytes]
+
+
+def filter_stream(src_path, dst_path, filt, n, band=64):
+    """
+    Applies the greyscale filter filt, whose output pixels depend only on the
+    nxn window around them (n is 3 for edges, or the kernel size for blurred
+    and sharpened), to the image file at src_path and saves the result to
+    dst_path, keeping only about band + n rows in memory.
+
+    Invoked as, for example:
+       filter_stream('huge.pgm', 'huge_blurred.pgm', lambda i: blurred(i, 5), 5)
+    """
+    width, height, rows = read_rows(src_path)
+    write_rows(dst_path, width, height,
+               filter_rows(rows, width, height, filt, n, band))
+
+
 if __name__ == '__main__':
     # code in this block will only be run when you explicitly run your script,
     # and not when the tests are being run.  this is a good place for
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import os
+import math
 import pickle
 import hashlib
+from array import array
 
 import lab
 import pytest
@@ -87,6 +89,63 @@ def test_inverted_images(fname):
     compare_images(result, expected)
 
 
+def test_lookup_tables():
+    image = {'height': 2, 'width': 3, 'pixels': [0, 17, 128, 200, 254, 255]}
+    threshold = lambda c: 255 if c >= 128 else 0
+    expected = [threshold(255 - c) for c in image['pixels']]
+    lut = lab.compose_luts(lab.INVERTED_LUT, lab.get_lut(threshold))
+    assert lab.apply_lut(image, lut)['pixels'] == expected
+    assert lab.apply_per_pixel(image, threshold)['pixels'] == [threshold(c) for c in image['pixels']]
+    compact = lab.apply_lut(lab.compact_image(image), lut)
+    assert compact['pixels'].typecode == 'B' and list(compact['pixels']) == expected
+    floats = {'height': 1, 'width': 2, 'pixels': [0.5, 300]}
+    assert lab.inverted(floats)['pixels'] == [254.5, -45]
+    with pytest.raises(ValueError):
+        lab.compose_luts(lab.get_lut(lambda c: c / 2), lab.INVERTED_LUT)
+    gamma = lambda c: 255 * (c / 255) ** .5
+    for use_lut in (True, False):
+        result = lab.apply_per_pixel(lab.compact_image(image), gamma, use_lut)
+        assert result['pixels'].typecode == 'd'
+        assert list(result['pixels']) == [gamma(c) for c in image['pixels']]
+    sparse = {'height': 1, 'width': 3, 'pixels': [1, 2, 4]}
+    assert lab.apply_per_pixel(sparse, lambda c: 255 // c)['pixels'] == [255, 127, 63]
+    compact = lab.apply_per_pixel(lab.compact_image(sparse), lambda c: 255 // c)
+    assert compact['pixels'].typecode == 'B' and list(compact['pixels']) == [255, 127, 63]
+
+def test_luminance(tmp_path):
+    values = [(r, g, b) for r in range(0, 256, 15) for g in range(0, 256, 17)
+              for b in (0, 1, 127, 128, 255)]
+    expected = [round(.299 * r + .587 * g + .114 * b) for r, g, b in values]
+    red, green, blue = (bytes(c) for c in zip(*values))
+    assert lab.luminance(red, green, blue) == expected
+    assert lab.greyscale_row(bytes(c for pixel in values for c in pixel)) == bytes(expected)
+    path = str(tmp_path / 'color.png')
+    img = lab.Image.new('RGB', (len(values), 1))
+    img.putdata(values)
+    img.save(path)
+    assert lab.load_image(path)['pixels'] == expected
+    if lab.np is not None:
+        try:
+            lab.set_backend('numpy')
+            assert lab.luminance(red, green, list(blue)) == expected
+        finally:
+            lab.set_backend('python')
+
+def test_compact_io(tmp_path):
+    image = {'height': 5, 'width': 7, 'pixels': [(i * 53) % 256 for i in range(35)]}
+    path = str(tmp_path / 'grey.png')
+    lab.save_image(image, path)
+    assert lab.load_image(path) == image
+    compact = lab.load_image(path, compact=True)
+    assert compact['pixels'].typecode == 'B' and list(compact['pixels']) == image['pixels']
+    lab.save_image(lab.inverted(compact), path)
+    assert lab.load_image(path)['pixels'] == [255 - c for c in image['pixels']]
+    lab.save_image({'height': 1, 'width': 2, 'pixels': [1.0, 300]}, path)
+    assert lab.load_image(path)['pixels'] == [1, 255]
+    for pixels in (array('d', [1.0, 2.0, 3.0, 4.0]), array('q', [1, 2, 3, 4])):
+        lab.save_image({'height': 2, 'width': 2, 'pixels': pixels}, path)
+        assert lab.load_image(path)['pixels'] == [1, 2, 3, 4]
+
 def test_roundclip_1():
     input =  {
         'height': 3,
@@ -101,6 +160,24 @@ def test_roundclip_1():
     lab.round_and_clip_image(input)
     compare_images(input, expected)
 
+def test_roundclip_fused():
+    image = {'height': 3, 'width': 4, 'pixels': [0, 50, 100, 255, 7, 9, 200, 3, 128, 64, 32, 16]}
+    kernel = {'size': 3, 'flat_kernel': [0, -0.5, 0, -0.5, 3.5, -0.5, 0, -0.5, 0]}
+    expected = lab.correlate(image, kernel, method='direct')
+    copy = lab.rounded_and_clipped(expected)
+    lab.round_and_clip_image(expected)
+    compare_images(copy, expected)
+    for method in ('direct', 'separable', 'fft'):
+        if method == 'separable':
+            kernel = lab.get_boxblur(3)
+            expected = lab.rounded_and_clipped(lab.correlate(image, kernel))
+        if method == 'fft' and lab.np is None:
+            continue
+        compare_images(lab.correlate(image, kernel, method=method, clip=True), expected)
+        result = lab.correlate(lab.compact_image(image), kernel, method=method, clip=True)
+        assert result['pixels'].typecode == 'B'
+        compare_images(lab.expand_image(result), expected)
+
 def test_correlate_1():
     image =  {
         'height': 3,
@@ -135,6 +212,175 @@ def test_correlate_2():
     }
     compare_images(lab.correlate(image, kernel), expected)
 
+def test_correlate_separable():
+    image = {
+        'height': 3,
+        'width': 4,
+        'pixels': [0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 6, 7],
+    }
+    sobel_x = {'size': 3, 'flat_kernel': [-1, 0, 1, -2, 0, 2, -1, 0, 1]}
+    assert lab.get_separable_factors(sobel_x) is not None
+    expected = {
+        'height': 3,
+        'width': 4,
+        'pixels': [4, 8, 8, 4] * 3,
+    }
+    compare_images(lab.correlate(image, sobel_x), expected)
+
+    gaussian = {'size': 3, 'flat_kernel': [1, 2, 1, 2, 4, 2, 1, 2, 1]}
+    expected = {
+        'height': 3,
+        'width': 4,
+        'pixels': [4, 16, 32, 44, 20, 32, 48, 60, 52, 64, 80, 92],
+    }
+    compare_images(lab.correlate(image, gaussian), expected)
+
+    not_separable = {'size': 3, 'flat_kernel': [0, 1, 0, 1, 1, 1, 0, 1, 0]}
+    assert lab.get_separable_factors(not_separable) is None
+
+def test_compile_kernel():
+    image = {'height': 4, 'width': 5, 'pixels': [(i * 29) % 17 for i in range(20)]}
+    kernel = {'size': 3, 'flat_kernel': [0, 1, 0, 1, -4, 1, 0, 1, 0]}
+    compiled = lab.compile_kernel(kernel)
+    assert compiled is lab.compile_kernel({'size': 3, 'flat_kernel': list(kernel['flat_kernel'])})
+    expected = [sum(lab.get_kernel(kernel, i, j) * lab.get_pixel(image, x + i - 1, y + j - 1)
+                    for i in range(3) for j in range(3))
+                for y in range(4) for x in range(5)]
+    assert compiled(image)['pixels'] == expected
+    assert lab.correlate(image, kernel)['pixels'] == expected
+
+def test_boundary_modes():
+    image = {'height': 1, 'width': 3, 'pixels': [10, 20, 30]}
+    reads = {boundary: [lab.get_pixel(image, x, 0, boundary) for x in range(-2, 5)]
+             for boundary in lab.BOUNDARIES}
+    assert reads['extend'] == [10, 10, 10, 20, 30, 30, 30]
+    assert reads['zero'] == [0, 0, 10, 20, 30, 0, 0]
+    assert reads['wrap'] == [20, 30, 10, 20, 30, 10, 20]
+    assert reads['reflect'] == [30, 20, 10, 20, 30, 20, 10]
+
+    kernel = {'size': 3, 'flat_kernel': [0, 0, 0, 1, 2, 3, 0, 0, 0]}
+    assert lab.correlate(image, kernel, boundary='reflect')['pixels'] == [100, 140, 140]
+    assert lab.correlate(image, kernel, boundary='zero')['pixels'] == [80, 140, 80]
+    assert lab.blurred(image, 3, boundary='zero')['pixels'] == [3, 7, 6]
+
+def test_box_sum():
+    image = {'height': 2, 'width': 3, 'pixels': [1, 2, 3, 4, 5, 6]}
+    result = lab.box_sum(image, 3)
+    assert result['pixels'] == [21, 27, 33, 30, 36, 42]
+    for n in (1, 2, 5, 8):
+        ones = {'size': n, 'flat_kernel': [1] * n ** 2}
+        assert lab.box_sum(image, n) == lab.correlate(image, ones)
+    assert image['pixels'] == [1, 2, 3, 4, 5, 6], 'Be careful not to modify the original image!'
+
+def test_compact_images():
+    image = {'height': 3, 'width': 4, 'pixels': [0, 10, 200, 30, 5, 15, 255, 35, 50, 60, 70, 80]}
+    compact = lab.compact_image(image)
+    assert compact['pixels'].typecode == 'B'
+    compare_images(lab.expand_image(compact), image)
+
+    for result, expected in ((lab.inverted(compact), lab.inverted(image)),
+                             (lab.blurred(compact, 3), lab.blurred(image, 3)),
+                             (lab.sharpened(compact, 3), lab.sharpened(image, 3)),
+                             (lab.edges(compact), lab.edges(image))):
+        assert result['pixels'].typecode == 'B'
+        compare_images(lab.expand_image(result), expected)
+
+    rows = lab.image_rows(compact, 1, 3)
+    assert isinstance(rows['pixels'], memoryview)
+    assert list(rows['pixels']) == image['pixels'][4:]
+
+def test_numpy_backend():
+    pytest.importorskip('numpy')
+    image = {'height': 4, 'width': 5, 'pixels': [(i * 37) % 256 for i in range(20)]}
+    kernel = {'size': 3, 'flat_kernel': [0, -1, 0, -1, 5, -1, 0, -1, 0]}
+    filters = [lambda im: lab.inverted(im), lambda im: lab.correlate(im, kernel),
+               lambda im: lab.blurred(im, 3), lambda im: lab.sharpened(im, 5),
+               lambda im: lab.edges(im)]
+    expected = [f(image) for f in filters]
+    try:
+        assert lab.set_backend('numpy') == 'numpy'
+        for f, exp in zip(filters, expected):
+            assert f(image) == exp
+    finally:
+        lab.set_backend('python')
+
+def test_correlate_fft():
+    pytest.importorskip('numpy')
+    image = {'height': 6, 'width': 7, 'pixels': [(i * 41) % 256 for i in range(42)]}
+    kernel = {'size': 5, 'flat_kernel': [(i * i) % 7 - 3 for i in range(25)]}
+    for boundary in lab.BOUNDARIES:
+        assert (lab.correlate(image, kernel, boundary=boundary, method='fft')
+                == lab.correlate(image, kernel, boundary=boundary, method='direct'))
+    assert lab.choose_correlation_method(3, 3, kernel) == 'direct'
+    assert lab.choose_correlation_method(1000, 1000, kernel) == 'direct'
+    large = {'size': 15, 'flat_kernel': [(i * i) % 7 - 3 for i in range(225)]}
+    assert lab.choose_correlation_method(1000, 1000, large) == 'direct'
+    try:
+        lab.set_backend('numpy')
+        assert lab.choose_correlation_method(1000, 1000, kernel) == 'direct'
+        assert lab.choose_correlation_method(1000, 1000, large) == 'fft'
+    finally:
+        lab.set_backend('python')
+
+def test_correlate_auto_exact():
+    image = {'height': 40, 'width': 40, 'pixels': [(i * 37) % 256 for i in range(1600)]}
+    kernel = {'size': 3, 'flat_kernel': [0, 0, 0, 0, .5, .5, 0, 0, 0]}
+    result = lab.correlate(image, kernel)
+    expected = lab.correlate(image, kernel, method='direct')
+    assert result == expected
+    assert lab.rounded_and_clipped(result) == lab.rounded_and_clipped(expected)
+    # Non-dyadic factors would round differently when applied in two passes
+    image = {'height': 8, 'width': 8, 'pixels': [(i * 97) % 256 for i in range(64)]}
+    kernel = {'size': 3, 'flat_kernel': [a * b for a in (1/3, 1, 1/3) for b in (.1, 1, .1)]}
+    assert lab.correlate(image, kernel) == lab.correlate(image, kernel, method='direct')
+
+def test_parallel_filters():
+    image = {'height': 7, 'width': 5, 'pixels': [(i * 53) % 256 for i in range(35)]}
+    kernel = {'size': 3, 'flat_kernel': [0, -1, 0, -1, 5, -1, 0, -1, 0]}
+    compare_images(lab.blurred(image, 3, workers=3), lab.blurred(image, 3))
+    compare_images(lab.sharpened(image, 5, workers=2), lab.sharpened(image, 5))
+    compare_images(lab.edges(image, workers=3), lab.edges(image))
+    assert lab.correlate(image, kernel, workers=2) == lab.correlate(image, kernel)
+    column = {'height': 4, 'width': 1, 'pixels': [0, 100, 200, 50]}
+    even = {'size': 4, 'flat_kernel': [(i * 5) % 7 - 2 for i in range(16)]}
+    for boundary in ('zero', 'reflect'):
+        for im in (image, column):
+            for workers in (im['height'] - 1, im['height']):
+                for n in (2, 4):
+                    compare_images(lab.blurred(im, n, workers=workers, boundary=boundary),
+                                   lab.blurred(im, n, boundary=boundary))
+                    compare_images(lab.sharpened(im, n, workers=workers, boundary=boundary),
+                                   lab.sharpened(im, n, boundary=boundary))
+                assert (lab.correlate(im, even, workers=workers, boundary=boundary)
+                        == lab.correlate(im, even, boundary=boundary))
+
+def test_edges_direction():
+    image = {'height': 3, 'width': 4, 'pixels': [0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 6, 7]}
+    magnitude, direction = lab.edges(image, direction=True)
+    compare_images(magnitude, lab.edges(image))
+    assert magnitude['pixels'][5] == round(math.sqrt(8 ** 2 + 16 ** 2))
+    assert direction['pixels'][5] == math.atan2(16, 8)
+    assert direction['pixels'][0] == math.atan2(0, 4)
+
+def test_edges_empty():
+    for width, height in ((0, 3), (3, 0)):
+        image = {'height': height, 'width': width, 'pixels': []}
+        for boundary in lab.BOUNDARIES:
+            assert lab.edges(image, boundary=boundary) == image
+            magnitude, direction = lab.edges(image, direction=True, boundary=boundary)
+            assert magnitude == direction == image
+
+@pytest.mark.parametrize("extension", ['pgm', 'png'])
+def test_filter_stream(tmp_path, extension):
+    image = {'height': 9, 'width': 6, 'pixels': [(i * 71) % 256 for i in range(54)]}
+    src = str(tmp_path / ('in.%s' % extension))
+    dst = str(tmp_path / ('out.%s' % extension))
+    lab.save_image(image, src)
+    lab.filter_stream(src, dst, lambda im: lab.blurred(im, 5), 5, band=2)
+    compare_images(lab.load_image(dst), lab.blurred(image, 5))
+    lab.filter_stream(src, dst, lab.edges, 3, band=4)
+    compare_images(lab.load_image(dst), lab.edges(image))
+
 
 @pytest.mark.parametrize("kernsize", [1, 3, 7])
 @pytest.mark.parametrize("fname", ['mushroom', 'twocats', 'chess'])
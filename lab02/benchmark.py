@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the color filters and seam carving of lab.py.
+
+Times color_filter_from_greyscale_filter (around blurred, sharpened, edges
+and inverted), filter_cascade and seam_carving on synthetic color images,
+reporting throughput in megapixels per second and peak memory, and stores
+the results as JSON so runs from different commits can be compared:
+   python3 benchmark.py --sizes 256 1024 --output before.json
+   python3 benchmark.py --sizes 256 1024 --compare before.json
+With --profile, one run of seam carving on each size is profiled stage by
+stage (see lab.profile_seams) and saved as collapsed stacks for a flame graph:
+   python3 benchmark.py --sizes 256 --benchmarks seam_carving --profile seams.txt
+(See lab01/benchmark.py for the greyscale filters, and
+lab01/benchmark_helpers.py for the timing and result file helpers.)
+"""
+
+import os
+import sys
+import random
+import argparse
+
+import lab
+
+# Appended rather than prepended, so that lab stays this directory's lab.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lab01'))
+from benchmark_helpers import (time_call, peak_memory, write_results,
+                               compare_results)
+
+
+def random_color_image(width, height, seed=0):
+    """
+    Returns a width x height color image with random pixels.
+    """
+    rng = random.Random(seed)
+    return {
+        'height': height,
+        'width': width,
+        'pixels': [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                   for _ in range(width * height)],
+    }
+
+
+def color(filt):
+    """
+    Returns the color version of a greyscale filter.
+    """
+    return lab.color_filter_from_greyscale_filter(filt)
+
+
+# (name, function of n returning a filter); n is None for filters without a
+# kernel size, and is the number of columns removed for seam carving
+BENCHMARKS = [
+    ('color_blurred', lambda n: color(lab.make_blur_filter(n))),
+    ('color_sharpened', lambda n: color(lab.make_sharpen_filter(n))),
+    ('color_edges', None),
+    ('color_inverted', None),
+    ('filter_cascade', None),
+    ('seam_carving', lambda n: lambda image: lab.seam_carving(image, n)),
+]
+
+FIXED_FILTERS = {
+    'color_edges': lambda: color(lab.edges),
+    'color_inverted': lambda: color(lab.inverted),
+    'filter_cascade': lambda: lab.filter_cascade([color(lab.edges),
+                                                  color(lab.inverted),
+                                                  color(lab.make_blur_filter(3))]),
+}
+
+
+def run_suite(sizes, kernel_sizes, seams, names=None, repeat=3, memory=True):
+    """
+    Runs the benchmarks (all of them, or those in names) on size x size images
+    with each kernel size (or number of seams), and returns a list of result
+    dictionaries.
+    """
+    results = []
+    for size in sizes:
+        image = random_color_image(size, size)
+        for name, make_filter in BENCHMARKS:
+            if names and name not in names:
+                continue
+            if make_filter is None:
+                filters = [(None, FIXED_FILTERS[name]())]
+            else:
+                counts = seams if name == 'seam_carving' else kernel_sizes
+                filters = [(n, make_filter(n)) for n in counts]
+            for n, filt in filters:
+                call = lambda: filt(image)
+                seconds = time_call(call, repeat)
+                results.append({
+                    'name': name,
+                    'size': size,
+                    'n': n,
+                    'seconds': seconds,
+                    'megapixels_per_second': size * size / seconds / 1e6,
+                    'peak_bytes': peak_memory(call) if memory else None,
+                })
+                print('%-16s %6d %4s %10.4fs %10.3f MP/s' % (
+                    name, size, n or '-', seconds, results[-1]['megapixels_per_second']))
+    return results
+
+
+def profile_seam_carving(sizes, seams, filename):
+    """
+    Profiles seam carving on size x size images for each number of seams,
+    prints the time spent in each stage and saves the collapsed stacks of
+    all the runs to filename.
+    """
+    with lab.profile_seams() as profile:
+        for size in sizes:
+            image = random_color_image(size, size)
+            for n in seams:
+                lab.seam_carving(image, n)
+    for name, stage in sorted(lab.profile_summary(profile).items(),
+                              key=lambda item: -item[1]['self_seconds']):
+        print('%-32s %6d calls %10.4fs' % (name, stage['calls'], stage['self_seconds']))
+    lab.write_profile(profile, filename, 'collapsed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024, 4096])
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 5, 9, 15, 25, 51])
+    parser.add_argument('--seams', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--backend', choices=['python', 'numpy'], default='python')
+    parser.add_argument('--benchmarks', nargs='+', choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    parser.add_argument('--threshold', type=float, default=1.1)
+    parser.add_argument('--profile', help='file to save seam carving stacks to')
+    parsed = parser.parse_args()
+
+    lab.lab1.set_backend(parsed.backend)
+    results = run_suite(parsed.sizes, parsed.kernels, parsed.seams,
+                        parsed.benchmarks, parsed.repeat, not parsed.no_memory)
+    if parsed.output:
+        write_results(results, parsed.output, lab.lab1.backend)
+    if parsed.profile:
+        profile_seam_carving(parsed.sizes, parsed.seams, parsed.profile)
+    if parsed.compare and compare_results(results, parsed.compare, parsed.threshold, 16):
+        sys.exit(1)
@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
 
-# NO ADDITIONAL IMPORTS!
-# (except in the last part of the lab; see the lab writeup for details)
+import json
 import math
+import time
+import operator
+import functools
+import itertools
+import bisect
+import hashlib
+import contextlib
+import collections
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from PIL import Image
 import lab1
 
@@ -34,12 +45,66 @@ def edges(image):
 
 # LAB 2 FILTERS
 
+# Planar color images store 'planes', a tuple of three array('B') buffers with
+# the red, green and blue values in row-major order, instead of a 'pixels'
+# list of (r, g, b) tuples.
+
+
+def is_planar(image):
+    """
+    Returns True if the color image is stored as planes.
+    """
+    return 'planes' in image
+
+
+def get_plane(pixels):
+    """
+    Returns the given channel pixels as an array('B') plane, without copying
+    them if they already are one.
+    """
+    if isinstance(pixels, array) and pixels.typecode == 'B':
+        return pixels
+    return array('B', pixels)
+
+
+def compact_color_image(image):
+    """
+    Returns a planar copy of the given color image.
+    """
+    if is_planar(image):
+        planes = tuple(array('B', plane) for plane in image['planes'])
+    else:
+        interleaved = array('B', itertools.chain.from_iterable(image['pixels']))
+        planes = tuple(interleaved[i::3] for i in range(3))
+    return {'height': image['height'], 'width': image['width'], 'planes': planes}
+
+
+def expand_color_image(image):
+    """
+    Returns a copy of the given color image with a 'pixels' list of (r, g, b)
+    tuples, the format used by the 6.009 tests.
+    """
+    if is_planar(image):
+        pixels = list(zip(*image['planes']))
+    else:
+        pixels = image['pixels'][:]
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
 
 def extract_rgb(image):
     """
     Given an r, g, b image, returns a tuple of single color
     images. Each similar to a greyscale image
+
+    The channels of a planar image share its buffers instead of copying them.
     """
+    if is_planar(image):
+        return tuple({
+            'height': image['height'],
+            'width': image['width'],
+            'pixels': plane,
+        } for plane in image['planes'])
+
     r = {
         'height': image['height'],
         'width': image['width'],
@@ -71,7 +136,19 @@ def make_rgb(red_image, green_image, blue_image):
     Given images representing the red, green, and blue channels of the
     same image, returns the composition of them into a single colored
     image.
+
+    Compact channel images of bytes ('B' buffers) are composed into a planar
+    image; other channels, such as float results, into a list of tuples.
     """
+    channels = (red_image, green_image, blue_image)
+    if all(lab1.is_compact(channel) and lab1.get_typecode(channel['pixels']) == 'B'
+           for channel in channels):
+        return {
+            'height': red_image['height'],
+            'width': red_image['width'],
+            'planes': tuple(get_plane(channel['pixels']) for channel in channels),
+        }
+
     image = {
         'height': red_image['height'],
         'width': red_image['width']
@@ -83,14 +160,96 @@ def make_rgb(red_image, green_image, blue_image):
     return image
 
 
-def color_filter_from_greyscale_filter(filt):
+def filter_plane(filt, source_name, target_name, width, height, index):
+    """
+    Worker for filter_channels: applies filt to plane index of the planes in
+    the shared memory block source_name and writes the resulting plane at the
+    same place in the shared memory block target_name.
+    """
+    size = width * height
+    source = shared_memory.SharedMemory(name=source_name)
+    target = shared_memory.SharedMemory(name=target_name)
+    try:
+        plane = array('B')
+        plane.frombytes(source.buf[index * size:(index + 1) * size])
+        result = filt({'height': height, 'width': width, 'pixels': plane})
+        target.buf[index * size:(index + 1) * size] = get_plane(result['pixels'])
+    finally:
+        source.close()
+        target.close()
+
+
+def filter_channels(filt, channels, workers):
+    """
+    Returns the list of filt(channel) for the given channel images, computed
+    concurrently by up to workers (at most one per channel).
+
+    With the NumPy backend, which releases the GIL in its array operations,
+    the channels are filtered in threads. Otherwise they are filtered in
+    processes, which read and write their planes through shared memory (so
+    only their names are pickled, together with filt, which must be
+    picklable: a module-level function or a functools.partial of one, like
+    make_blur_filter's).
+    """
+    workers = min(workers, len(channels))
+    if lab1.backend == 'numpy':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(filt, channels))
+
+    width = channels[0]['width']
+    height = channels[0]['height']
+    size = width * height
+    total = size * len(channels)
+    source = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    target = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    try:
+        for i, channel in enumerate(channels):
+            source.buf[i * size:(i + 1) * size] = get_plane(channel['pixels'])
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(filter_plane, filt, source.name, target.name,
+                                       width, height, i)
+                       for i in range(len(channels))]
+            for future in futures:
+                future.result()
+
+        filtered_images = []
+        for i, channel in enumerate(channels):
+            plane = array('B')
+            plane.frombytes(target.buf[i * size:(i + 1) * size])
+            filtered_images.append({
+                'height': height,
+                'width': width,
+                'pixels': plane if lab1.is_compact(channel) else plane.tolist(),
+            })
+    finally:
+        source.close()
+        source.unlink()
+        target.close()
+        target.unlink()
+    return filtered_images
+
+
+def color_filter_from_greyscale_filter(filt, workers=None):
     """
     Given a filter that takes a greyscale image as input and produces a
     greyscale image as output, returns a function that takes a color image as
     input and produces the filtered color image.
+
+    Planar images are filtered directly on their planes, and give planar
+    images; the returned function has a true planar attribute, which tells
+    filter_cascade it need not expand them.
+
+    If workers is given, the three channels are filtered concurrently (see
+    filter_channels).
     """
     def color_filter(image):
         red_image, green_image, blue_image = extract_rgb(image)
+        if workers is not None and workers > 1:
+            filtered_images = filter_channels(
+                filt, [red_image, green_image, blue_image], workers)
+            return make_rgb(*filtered_images)
+
         filtered_images = []
         for source_image in [red_image, green_image, blue_image]:
             filtered_images.append(filt(source_image))
@@ -98,6 +257,9 @@ def color_filter_from_greyscale_filter(filt):
         new_color_image = make_rgb(*filtered_images)
         return new_color_image
 
+    color_filter.planar = True
+    color_filter.filt = filt
+    color_filter.workers = workers
     return color_filter
 
 
@@ -105,10 +267,10 @@ def make_blur_filter(n):
     """
     Given a size n, returns a blur filter function of kernel size
     n x n.
+
+    (A partial of blurred, so that it can be pickled to worker processes.)
     """
-    def blur_filter(image):
-        return blurred(image, n)
-    return blur_filter
+    return functools.partial(blurred, n=n)
 
 
 def make_sharpen_filter(n):
@@ -116,22 +278,145 @@ def make_sharpen_filter(n):
     Given a size n, returns a sharpen filter function of kernel size
     n x n.
     """
-    def sharpen_filter(image):
-        return sharpened(image, n)
-    return sharpen_filter
+    return functools.partial(sharpened, n=n)
+
+
+def correlated(image, kernel):
+    """
+    Returns the image correlated with the kernel, rounded and clipped: the
+    filter of an arbitrary kernel, such as the fused kernels of plan_cascade.
+    """
+    return lab1.correlate(image, kernel, clip=True)
+
+
+def get_filter_kernel(filt):
+    """
+    Returns the kernel of a linear greyscale filter made by make_blur_filter,
+    make_sharpen_filter or plan_cascade, or None for other filters.
+    """
+    if not isinstance(filt, functools.partial) or filt.args:
+        return None
+    if filt.func is blurred and set(filt.keywords) == {'n'}:
+        return lab1.get_boxblur(filt.keywords['n'])
+    if filt.func is sharpened and set(filt.keywords) == {'n'}:
+        return lab1.get_sharpkernel(filt.keywords['n'])
+    if filt.func is correlated and set(filt.keywords) == {'kernel'}:
+        return filt.keywords['kernel']
+    return None
+
+
+def convolve_kernels(first, second):
+    """
+    Returns the kernel whose correlation is that of first followed by second
+    (ignoring the boundaries and the rounding between them). The taps of the
+    result at offset d from the center sum first[a] * second[b] for a + b = d.
+    """
+    n_a, n_b = first['size'], second['size']
+    taps = {}
+    for i, weight_a in enumerate(first['flat_kernel']):
+        if not weight_a:
+            continue
+        ax, ay = i % n_a - n_a // 2, i // n_a - n_a // 2
+        for j, weight_b in enumerate(second['flat_kernel']):
+            if weight_b:
+                offset = (ax + j % n_b - n_b // 2, ay + j // n_b - n_b // 2)
+                taps[offset] = taps.get(offset, 0) + weight_a * weight_b
+    # correlate centers an nxn kernel at index n // 2, so the size must have
+    # the combined center there (and room for the taps past it)
+    mid = n_a // 2 + n_b // 2
+    high = max([0] + [max(dx, dy) for dx, dy in taps])
+    n = 2 * mid if high < mid else 2 * mid + 1
+    flat_kernel = [0] * (n * n)
+    for (dx, dy), weight in taps.items():
+        flat_kernel[dx + mid + (dy + mid) * n] = weight
+    return {'size': n, 'flat_kernel': flat_kernel}
+
+
+def describe_filter(filt):
+    """
+    Returns (kind, greyscale filter, color) for a filter given to
+    filter_cascade, where kind is 'inverted' or 'linear' for the filters
+    plan_cascade can rewrite and None for any other, and color tells whether
+    filt is a color filter made by color_filter_from_greyscale_filter.
+    """
+    color = getattr(filt, 'planar', False)
+    grey = filt.filt if color else filt
+    if grey is inverted or grey is lab1.inverted:
+        return 'inverted', grey, color
+    if get_filter_kernel(grey) is not None:
+        return 'linear', grey, color
+    return None, grey, color
 
 
-def filter_cascade(filters):
+def plan_cascade(filters, exact=True):
+    """
+    Returns the list of filters to apply in place of the given ones, which
+    filter_cascade runs:
+    - pairs of consecutive inversions cancel out (exactly, on 8-bit images,
+      which all of these filters produce),
+    - if exact is False, runs of consecutive linear filters (blurs, sharpens)
+      are also fused into a single correlation with the convolution of their
+      kernels. This skips the rounding and clipping between them and handles
+      the image edges differently, so pixel values may differ slightly.
+    Color and greyscale filters are never combined with each other.
+    """
+    plan = []
+    for filt in filters:
+        kind, grey, color = describe_filter(filt)
+        if plan:
+            last_kind, last_grey, last_color = describe_filter(plan[-1])
+            if kind is not None and kind == last_kind and color == last_color:
+                if kind == 'inverted':
+                    plan.pop()
+                    continue
+                if not exact:
+                    kernel = convolve_kernels(get_filter_kernel(last_grey),
+                                              get_filter_kernel(grey))
+                    fused = functools.partial(correlated, kernel=kernel)
+                    if color:
+                        fused = color_filter_from_greyscale_filter(fused,
+                                                                   plan[-1].workers)
+                    plan[-1] = fused
+                    continue
+        plan.append(filt)
+    return plan
+
+
+def filter_cascade(filters, exact=True):
     """
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    The filters are first rewritten by plan_cascade (with the given exact
+    flag); the plan is kept in the plan attribute of the returned function.
+
+    Color images are converted to planar images once, before the first filter
+    that takes them (see color_filter_from_greyscale_filter), instead of being
+    split and merged by every filter, and are only expanded again for filters
+    that need a 'pixels' list and for the result, which is stored the same way
+    as the given image.
     """
     def apply_filters(image):
+        if not plan:
+            # All the filters cancelled out
+            return copy_color_image(image)
         new_img = image.copy()
-        for filter in filters:
+        color = is_planar(image) or (image['pixels'] != []
+                                     and isinstance(image['pixels'][0], tuple))
+        for filter in plan:
+            if color and getattr(filter, 'planar', False):
+                if not is_planar(new_img):
+                    new_img = compact_color_image(new_img)
+            elif is_planar(new_img):
+                new_img = expand_color_image(new_img)
             new_img = filter(new_img)
+        if is_planar(new_img) and not is_planar(image):
+            new_img = expand_color_image(new_img)
         return new_img
+
+    plan = plan_cascade(filters, exact)
+    apply_filters.plan = plan
     return apply_filters
 
 
@@ -139,36 +424,262 @@ def filter_cascade(filters):
 
 # Main Seam Carving Implementation
 
-def seam_carving(image, ncols):
+def seam_carving(image, ncols, batch=1):
     """
     Starting from the given image, use the seam carving technique to remove
     ncols (an integer) columns from the image.
+
+    The greyscale image, energy and cumulative energy map are computed once
+    and then kept up to date as seams are removed: removing a seam only
+    changes the energy of the pixels next to it (see update_energy), and the
+    cumulative energy below them (see update_cumulative_energy_map).
+
+    With batch=1 (the default) seams are removed one at a time, exactly as
+    described in the lab 2 writeup. A larger batch trades quality for speed:
+    up to batch non-crossing seams are taken from each cumulative energy map
+    (see seam_carving_batches).
     """
-    new_img = {
-        'width': image['width'],
-        'height': image['height'],
-        'pixels': image['pixels'][:]
-    }
-    for _ in range(ncols):
-        seam = minimum_energy_seam(
-            cumulative_energy_map(
-                compute_energy(
-                    greyscale_image_from_color_image(new_img))))
-        new_img = image_without_seam(new_img, seam)
+    return remove_seams(image, ncols, True, batch)
 
+
+def remove_seams(image, count, vertical=True, batch=1):
+    """
+    Removes count seams from the given (color or planar) image: vertical
+    seams, which remove columns, or horizontal seams, which remove rows (see
+    seam_carving).
+    """
+    if count <= 0:
+        return copy_color_image(image)
+    if batch > 1:
+        return seam_carving_batches(image, count, batch, vertical)
+    remove = image_without_columns if vertical else image_without_rows
+    new_img = image
+    for positions in seam_sequence(image, count, vertical):
+        new_img = remove(new_img, positions)
     return new_img
 
 
+def seam_sequence(image, count, vertical=True):
+    """
+    Yields, for each of the count seams removed one at a time from the given
+    image, the list of its positions in each line of the image it is removed
+    from (see seam_positions).
+
+    The energy and cumulative energy map are updated incrementally between
+    seams, and nothing is recomputed after the last one.
+    """
+    remove = image_without_columns if vertical else image_without_rows
+    grey = greyscale_image_from_color_image(image)
+    energy = compute_energy(grey)
+    cem = cumulative_energy_map(energy, vertical=vertical)
+    for i in range(count):
+        seam = minimum_energy_seam(cem, vertical=vertical)
+        positions = seam_positions(seam, grey['width'], grey['height'], vertical)
+        yield positions
+        if i == count - 1:
+            break
+        grey = remove(grey, positions)
+        energy = remove(energy, positions)
+        cem = remove(cem, positions)
+        spans = update_energy(grey, energy, positions, vertical)
+        update_cumulative_energy_map(cem, energy, spans, vertical)
+
+
+def seam_carving_batches(image, ncols, batch, vertical=True):
+    """
+    Removes ncols columns (or rows, for horizontal seams) from the image in
+    passes that each compute the energy and cumulative energy map once and
+    remove up to batch non-crossing seams from it (see minimum_energy_seams),
+    so about ncols / batch passes are needed instead of ncols. Later seams of a
+    pass do not see the energy changes made by the earlier ones, so the
+    result is only an approximation of removing the seams one at a time.
+    """
+    while ncols > 0:
+        cem = cumulative_energy_map(
+            compute_energy(
+                greyscale_image_from_color_image(image)), vertical=vertical)
+        seams = minimum_energy_seams(cem, min(batch, ncols), vertical)
+        image = image_without_seams(image, seams, vertical)
+        ncols -= len(seams)
+    return image
+
+
+def insert_seams(image, count, vertical=True):
+    """
+    Enlarges the given (color or planar) image by count columns (or rows, for
+    horizontal seams): the non-crossing lowest-energy seams of an energy
+    pass (see minimum_energy_seams) are each widened by a new pixel, the
+    average of the seam pixel and the next one on its line.
+
+    A pass finds at most one seam per pixel of a line, and may find fewer
+    than asked for, so passes are repeated on the enlarged image until
+    count seams were inserted.
+    """
+    if count <= 0:
+        return copy_color_image(image)
+    while count > 0:
+        cem = cumulative_energy_map(
+            compute_energy(
+                greyscale_image_from_color_image(image)), vertical=vertical)
+        seams = minimum_energy_seams(cem, count, vertical)
+        image = image_with_seams(image, seams, vertical)
+        count -= len(seams)
+    return image
+
+
+def retarget(image, width, height, batch=1):
+    """
+    Returns the given (color or planar) image resized to width x height with
+    seam carving: columns are removed (or inserted) with vertical seams, then
+    rows with horizontal ones.
+    """
+    if width == image['width'] and height == image['height']:
+        return copy_color_image(image)
+    for vertical, change in ((True, width - image['width']),
+                             (False, height - image['height'])):
+        if change < 0:
+            image = remove_seams(image, -change, vertical, batch)
+        elif change > 0:
+            image = insert_seams(image, change, vertical)
+    return image
+
+
+# Seam Order Caching
+
+# Removing seams one at a time is deterministic, so the first k seams
+# removed from an image are the same for every k. A seam order records, for
+# each pixel of an image, which seam removed it; any number of seams up to
+# the one recorded can then be removed in O(width * height), without
+# computing any energy.
+
+SEAM_ORDER_CACHE_SIZE = 8
+SEAM_ORDER_CACHE = collections.OrderedDict()
+
+
+def seam_order(image, count, vertical=True):
+    """
+    Removes count seams from the given (color or planar) image, and returns
+    its seam order: a greyscale-like image whose pixel i is the number of
+    the seam (from 0) that removed pixel i of the image, or count if it was
+    not removed, in an array('I').
+    """
+    width = image['width']
+    height = image['height']
+    remove = image_without_columns if vertical else image_without_rows
+    order = array('I', [count]) * (width * height)
+    index = {'width': width, 'height': height,
+             'pixels': list(range(width * height))}
+    for n, positions in enumerate(seam_sequence(image, count, vertical)):
+        lines, length, line_step, step = get_seam_axes(
+            index['width'], index['height'], vertical)
+        index_pixels = index['pixels']
+        for i, p in enumerate(positions):
+            order[index_pixels[i * line_step + p * step]] = n
+        index = remove(index, positions)
+    return {'width': width, 'height': height, 'pixels': order}
+
+
+def image_from_seam_order(image, order, count, vertical=True):
+    """
+    Returns the given (color or planar) image without its first count seams,
+    given its seam order (see seam_order) with at least count seams, the
+    same image as remove_seams(image, count, vertical).
+    """
+    lines, length, line_step, step = get_seam_axes(image['width'], image['height'],
+                                                   vertical)
+    order_pixels = order['pixels']
+
+    def keep(line, i):
+        kept = order_pixels[line_slice(i, 0, length - 1, line_step, step)]
+        new_line = line[:0]
+        new_line.extend(itertools.compress(line, (n >= count for n in kept)))
+        return new_line
+
+    return map_lines(image, keep, length - count, vertical)
+
+
+def image_digest(image):
+    """
+    Returns a hash of the size and pixels of the given (greyscale, color or
+    planar) image, used to recognize images with the same content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(b'%d %d ' % (image['width'], image['height']))
+    if is_planar(image) or image['pixels'] and isinstance(image['pixels'][0], tuple):
+        # Planar and tuple color images with the same pixels have the same hash
+        for plane in compact_color_image(image)['planes']:
+            digest.update(plane)
+    else:
+        digest.update(repr(list(image['pixels'])).encode())
+    return digest.hexdigest()
+
+
+def cached_seam_order(image, count, vertical=True):
+    """
+    Returns a seam order (see seam_order) of the given image with at least
+    count seams, from SEAM_ORDER_CACHE if one was already computed for an
+    image with the same content. The cache keeps the SEAM_ORDER_CACHE_SIZE
+    most recently used seam orders.
+
+    The returned seam order is shared with the cache, and must not be
+    modified.
+    """
+    key = (image_digest(image), vertical)
+    entry = SEAM_ORDER_CACHE.get(key)
+    if entry is None or entry[0] < count:
+        entry = (count, seam_order(image, count, vertical))
+        SEAM_ORDER_CACHE[key] = entry
+    SEAM_ORDER_CACHE.move_to_end(key)
+    while len(SEAM_ORDER_CACHE) > SEAM_ORDER_CACHE_SIZE:
+        SEAM_ORDER_CACHE.popitem(last=False)
+    return entry[1]
+
+
+def seam_carving_widths(image, widths, vertical=True):
+    """
+    Returns the list of the given (color or planar) image carved down to each
+    of the given widths (or heights, for horizontal seams) by removing seams
+    one at a time. The seams are only computed once, down to the smallest
+    width (see cached_seam_order).
+    """
+    size = image['width'] if vertical else image['height']
+    counts = [size - width for width in widths]
+    order = cached_seam_order(image, max(counts, default=0), vertical)
+    return [image_from_seam_order(image, order, count, vertical)
+            if count > 0 else copy_color_image(image) for count in counts]
+
+
 # Optional Helper Functions for Seam Carving
 
+def copy_color_image(image):
+    """
+    Returns a copy of the given color (or planar, or greyscale) image.
+    """
+    if is_planar(image):
+        return compact_color_image(image)
+    return {
+        'width': image['width'],
+        'height': image['height'],
+        'pixels': image['pixels'][:]
+    }
+
+
 def greyscale_image_from_color_image(image):
     """
     Given a color image, computes and returns a corresponding greyscale image.
 
-    Returns a greyscale image (represented as a dictionary).
+    Returns a greyscale image (represented as a dictionary), compact if the
+    color image is planar.
+
+    The products of the formula are looked up per channel (see
+    lab1.luminance), so planes are converted without unpacking any pixel.
     """
-    greyscale_pixels = [round(.299*r + .587*g + .114*b)
-                        for r, g, b in image['pixels']]
+    if is_planar(image):
+        greyscale_pixels = array('B', lab1.luminance(*image['planes']))
+    else:
+        lut_r, lut_g, lut_b = lab1.LUMINANCE_LUTS
+        greyscale_pixels = [round(lut_r[r] + lut_g[g] + lut_b[b])
+                            for r, g, b in image['pixels']]
     return {
         'height': image['height'],
         'width': image['width'],
@@ -186,7 +697,72 @@ def compute_energy(grey):
     return edges(grey)
 
 
-def cumulative_energy_map(energy):
+# Seams cross the lines of an image: its rows for vertical seams (which
+# remove columns), its columns for horizontal seams (which remove rows).
+# Pixel p of line i is at index i * line_step + p * step of the row-major
+# buffers, so horizontal seams run on the same buffers as vertical ones
+# through strided slices, without transposing the image. Positions along a
+# line play the part of columns in the lab 2 writeup.
+
+def get_seam_axes(width, height, vertical=True):
+    """
+    Returns (lines, length, line_step, step) for seams of the given direction
+    in an image of the given size: the number of lines the seams cross, the
+    number of pixels in each line, and the index steps from a line to the
+    next and along a line.
+    """
+    if vertical:
+        return height, width, width, 1
+    return width, height, 1, width
+
+
+def line_slice(i, first, last, line_step, step):
+    """
+    Returns the slice of a row-major buffer holding pixels first..last of
+    line i (see get_seam_axes).
+    """
+    start = i * line_step
+    return slice(start + first * step, start + last * step + 1, step)
+
+
+def neighbor_minimums(row, first, last):
+    """
+    Returns the list of min(row[x - 1], row[x], row[x + 1]) for x in
+    first..last, with the indices clamped to the row, computed as a map over
+    three shifted slices of the row.
+    """
+    if first > last:
+        return []
+    centers = row[first:last + 1]
+    lefts = row[first - 1:last] if first > 0 else centers[:1] + row[first:last]
+    if last < len(row) - 1:
+        rights = row[first + 1:last + 2]
+    else:
+        rights = row[first + 1:last + 1] + centers[-1:]
+    return list(map(min, lefts, centers, rights))
+
+
+def neighbor_argmins(row, first, last):
+    """
+    Returns, for x in first..last, the column among x - 1, x and x + 1 (within
+    the row) holding the smallest of their values in row, preferring the
+    leftmost on ties, like minimum_energy_seam.
+    """
+    width = len(row)
+    columns = []
+    for x in range(first, last + 1):
+        left = row[x - 1] if x > 0 else row[x]
+        right = row[x + 1] if x < width - 1 else row[x]
+        if left <= row[x] and left <= right:
+            columns.append(x - 1 if x > 0 else x)
+        elif row[x] <= right:
+            columns.append(x)
+        else:
+            columns.append(x + 1)
+    return columns
+
+
+def cumulative_energy_map(energy, backpointers=False, vertical=True):
     """
     Given a measure of energy (e.g., the output of the compute_energy
     function), computes a "cumulative energy map" as described in the lab 2
@@ -195,23 +771,156 @@ def cumulative_energy_map(energy):
     Returns a dictionary with 'height', 'width', and 'pixels' keys (but where
     the values in the 'pixels' array may not necessarily be in the range [0,
     255].
+
+    Each row is computed at once from the previous one (see
+    neighbor_minimums, or NumPy with the NumPy backend). If backpointers is
+    True, returns a (map, back) pair, where back[i] is the column in the row
+    above of the pixel minimum_energy_seam continues to from pixel i.
+
+    If vertical is False, the map is accumulated from left to right instead,
+    for horizontal seams (back then holds rows in the column to the left).
     """
+    if lab1.backend == 'numpy':
+        return numpy_cumulative_energy_map(energy, backpointers, vertical)
     width = energy['width']
     height = energy['height']
+    lines, length, line_step, step = get_seam_axes(width, height, vertical)
+    pixels = list(energy['pixels'])
     cem = {
         'width': width,
         'height': height,
-        'pixels': energy['pixels'][:]
+        'pixels': pixels
     }
+    if backpointers:
+        back = [0] * (width * height)
+        back[line_slice(0, 0, length - 1, line_step, step)] = range(length)
 
     # Left top row untouched
-    for y in range(1, height):
-        for x in range(width):
-            current_value = lab1.get_pixel(cem, x, y)
-            adjacent_pixels = [lab1.get_pixel(
-                cem, x - i, y - 1) for i in [-1, 0, 1]]
-            lab1.set_pixel(cem, x, y, current_value + min(adjacent_pixels))
+    for i in range(1, lines):
+        above = pixels[line_slice(i - 1, 0, length - 1, line_step, step)]
+        here = line_slice(i, 0, length - 1, line_step, step)
+        pixels[here] = list(map(operator.add, pixels[here],
+                                neighbor_minimums(above, 0, length - 1)))
+        if backpointers:
+            back[here] = neighbor_argmins(above, 0, length - 1)
+
+    if backpointers:
+        return cem, back
+    return cem
+
+
+def numpy_cumulative_energy_map(energy, backpointers=False, vertical=True):
+    """
+    Computes cumulative_energy_map with NumPy, taking the minimum (and its
+    position, for the back pointers) over the three shifted copies of each
+    row above. Horizontal seams go through transposed views of the arrays.
+    """
+    np = lab1.np
+    width = energy['width']
+    height = energy['height']
+    values = np.array(energy['pixels']).reshape(height, width)
+    # Integer energies stay integers, as in the reference; others are floats
+    values = values.astype(np.int64 if values.dtype.kind in 'iub' else np.float64)
+    back = np.empty((height, width), dtype=np.int64)
+    lines, back_lines = (values, back) if vertical else (values.T, back.T)
+    positions = np.arange(lines.shape[1])
+    back_lines[0] = positions
+    for i in range(1, lines.shape[0]):
+        above = lines[i - 1]
+        # np.argmin returns the first minimum, i.e. prefers the left column
+        shifted = np.stack([np.concatenate((above[:1], above[:-1])), above,
+                            np.concatenate((above[1:], above[-1:]))])
+        choice = np.argmin(shifted, axis=0)
+        lines[i] += shifted[choice, positions]
+        back_lines[i] = np.maximum(positions + choice - 1, 0)
+    cem = {'width': width, 'height': height, 'pixels': values.ravel().tolist()}
+    if backpointers:
+        return cem, back.ravel().tolist()
+    return cem
+
+
+def pixel_energy(grey, x, y):
+    """
+    Returns the energy of pixel (x, y) of the greyscale image, as computed by
+    compute_energy: the magnitude of its Sobel gradient, rounded and clipped
+    as by edges.
+    """
+    def get(dx, dy):
+        return lab1.get_pixel(grey, x + dx, y + dy)
+    gx = (get(1, -1) - get(-1, -1) + 2 * (get(1, 0) - get(-1, 0))
+          + get(1, 1) - get(-1, 1))
+    gy = (get(-1, 1) - get(-1, -1) + 2 * (get(0, 1) - get(0, -1))
+          + get(1, 1) - get(1, -1))
+    magnitude = math.sqrt(gx * gx + gy * gy)
+    return 255 if magnitude > 255 else round(magnitude)
+
+
+def seam_positions(seam, width, height, vertical=True):
+    """
+    Given a seam (a list of indices, one per line, into the pixels of an
+    image of the given size), returns the list of the seam's position in each
+    line: its column in each row for vertical seams, its row in each column
+    for horizontal ones.
+    """
+    lines, length, line_step, step = get_seam_axes(width, height, vertical)
+    positions = [0] * lines
+    for i in seam:
+        positions[i // line_step % lines] = i // step % length
+    return positions
+
 
+def update_energy(grey, energy, positions, vertical=True):
+    """
+    Given the greyscale image and energy of an image from which a seam was
+    just removed (positions holds the seam's position in each line, in the
+    image before the removal), recomputes in place the energy of the pixels
+    whose 3x3 neighborhood changed, and returns the (first, last) positions
+    recomputed in each line.
+
+    Pixel x of row y has the same neighbors as before unless the removed
+    pixel of row y - 1, y or y + 1 was in its window, which only happens for
+    min(near) - 1 <= x <= max(near), where near are those removed columns
+    (and likewise along columns, for horizontal seams).
+    """
+    lines, length, line_step, step = get_seam_axes(grey['width'], grey['height'],
+                                                   vertical)
+    energy_pixels = energy['pixels']
+    spans = []
+    for i in range(lines):
+        near = positions[max(0, i - 1):i + 2]
+        first = max(0, min(near) - 1)
+        last = min(length - 1, max(near))
+        for p in range(first, last + 1):
+            x, y = (p, i) if vertical else (i, p)
+            energy_pixels[i * line_step + p * step] = pixel_energy(grey, x, y)
+        spans.append((first, last))
+    return spans
+
+
+def update_cumulative_energy_map(cem, energy, spans, vertical=True):
+    """
+    Given the cumulative energy map of an image from which a seam was just
+    removed (with the seam removed from it too), and the energy with the
+    spans returned by update_energy recomputed, recomputes in place the
+    cumulative energy that changed: the spans of the top row and, going
+    down, the union of each row's span with the cells below the previous
+    row's changed cells (which widen by one column on each side per row).
+    Returns the map.
+    """
+    lines, length, line_step, step = get_seam_axes(cem['width'], cem['height'],
+                                                   vertical)
+    pixels = cem['pixels']
+    energy_pixels = energy['pixels']
+    first, last = spans[0]
+    here = line_slice(0, first, last, line_step, step)
+    pixels[here] = energy_pixels[here]
+    for i in range(1, lines):
+        first = max(0, min(first - 1, spans[i][0]))
+        last = min(length - 1, max(last + 1, spans[i][1]))
+        above = pixels[line_slice(i - 1, 0, length - 1, line_step, step)]
+        here = line_slice(i, first, last, line_step, step)
+        pixels[here] = list(map(operator.add, energy_pixels[here],
+                                neighbor_minimums(above, first, last)))
     return cem
 
 
@@ -223,70 +932,457 @@ def get_flat_index(x, y, width):
     return y*width + x
 
 
-def minimum_energy_seam(cem):
+def minimum_energy_seam(cem, back=None, vertical=True):
     """
     Given a cumulative energy map, returns a list of the indices into the
     'pixels' list that correspond to pixels contained in the minimum-energy
     seam (computed as described in the lab 2 writeup).
+
+    If the back pointers of the map are given (see cumulative_energy_map),
+    the seam just follows them up from the bottom row.
+
+    If vertical is False, the map is one for horizontal seams, and the seam
+    is followed from the rightmost column to the left.
     """
     remove_indices = []
-    width = cem['width']
-    height = cem['height']
+    lines, length, line_step, step = get_seam_axes(cem['width'], cem['height'],
+                                                   vertical)
     cem_pixels = cem['pixels']
 
     # Get bottom of min seam
-    bottom: list = cem_pixels[-width:]
+    bottom: list = cem_pixels[line_slice(lines - 1, 0, length - 1, line_step, step)]
     x_bottom = bottom.index(min(bottom))
-    remove_indices.append(get_flat_index(x_bottom, height - 1, width))
+    remove_indices.append((lines - 1) * line_step + x_bottom * step)
 
     x_min = x_bottom
-    for y in reversed(range(height - 1)):
-        # Get (x, value) array of adjacent pixels on row
-        adjacent_pixels = [(x_min + i, lab1.get_pixel(cem, x_min + i, y))
-                           for i in [-1, 0, 1]]
-        (x_min, _) = min(adjacent_pixels, key=lambda x: x[1])
-        # Crop x_min between 0 and width - 1
-        x_min = min(max(0, x_min), width - 1)
-        remove_indices.append(get_flat_index(x_min, y, width))
+    for y in reversed(range(lines - 1)):
+        start = y * line_step
+        if back is not None:
+            x_min = back[start + line_step + x_min * step]
+        else:
+            # The smallest of the adjacent pixels on the row, leftmost first
+            center = cem_pixels[start + x_min * step]
+            left = cem_pixels[start + (x_min - 1) * step] if x_min > 0 else center
+            right = cem_pixels[start + (x_min + 1) * step] if x_min < length - 1 else center
+            if left <= center and left <= right:
+                x_min = max(x_min - 1, 0)
+            elif right < center:
+                x_min += 1
+        remove_indices.append(start + x_min * step)
 
     return remove_indices
 
 
-def image_without_seam(image, seam):
+def minimum_energy_seams(cem, count, vertical=True):
+    """
+    Given a cumulative energy map, returns a list of up to count connected
+    seams (lists of indices, as returned by minimum_energy_seam) that never
+    cross or touch.
+
+    The first seam is minimum_energy_seam(cem). Each next one starts from the
+    lowest remaining pixel of the bottom row and moves up to the lowest
+    adjacent pixel (the leftmost on ties) strictly between the seams already
+    found on its left and right. If those two seams close the gap, the seam
+    is dropped, so fewer than count seams may be returned (but always at
+    least one).
+    """
+    lines, length, line_step, step = get_seam_axes(cem['width'], cem['height'],
+                                                   vertical)
+    cem_pixels = cem['pixels']
+    bottom = (lines - 1) * line_step
+    # Bottom positions of the seams found, in order, and the seams'
+    # positions in each line, in the same order
+    starts = []
+    paths = []
+    seams = []
+    # sorted is stable, so ties start from the leftmost pixel
+    for x_bottom in sorted(range(length), key=lambda x: cem_pixels[bottom + x * step]):
+        if len(seams) == count:
+            break
+        k = bisect.bisect(starts, x_bottom)
+        left = paths[k - 1] if k > 0 else None
+        right = paths[k] if k < len(paths) else None
+        path = [x_bottom] * lines
+        x_min = x_bottom
+        for y in reversed(range(lines - 1)):
+            start = y * line_step
+            low = left[y] + 1 if left else 0
+            high = right[y] - 1 if right else length - 1
+            best = None
+            for x in (x_min - 1, x_min, x_min + 1):
+                if (low <= x <= high
+                        and (best is None or cem_pixels[start + x * step]
+                             < cem_pixels[start + best * step])):
+                    best = x
+            if best is None:
+                break
+            x_min = path[y] = best
+        else:
+            starts.insert(k, x_bottom)
+            paths.insert(k, path)
+            seams.append([y * line_step + path[y] * step
+                          for y in reversed(range(lines))])
+    return seams
+
+
+def get_seam_lines(image, seams, vertical=True):
+    """
+    Returns, for each line of the image (see get_seam_axes), the sorted list
+    of the positions of the given disjoint seams on that line.
+    """
+    lines, length, line_step, step = get_seam_axes(image['width'], image['height'],
+                                                   vertical)
+    positions = [[] for _ in range(lines)]
+    for seam in seams:
+        for i in seam:
+            positions[i // line_step % lines].append(i // step % length)
+    for line_positions in positions:
+        line_positions.sort()
+    return positions
+
+
+def map_lines(image, new_lines, new_length, vertical=True):
+    """
+    Returns a new image (greyscale, color or planar) whose lines are
+    new_lines(line, i) for each line i of the given image, all of them
+    new_length long: rows are concatenated, columns are written into the new
+    buffer with strided slices.
+    """
+    width = image['width']
+    height = image['height']
+    lines, length, line_step, step = get_seam_axes(width, height, vertical)
+
+    def map_buffer(pixels):
+        if vertical:
+            new_pixels = pixels[:0]
+            for i in range(lines):
+                new_pixels += new_lines(pixels[i * width:(i + 1) * width], i)
+            return new_pixels
+        new_pixels = pixels[:1] * (width * new_length)
+        for i in range(lines):
+            new_pixels[i::width] = new_lines(pixels[i::width], i)
+        return new_pixels
+
+    if vertical:
+        new_image = {'width': new_length, 'height': height}
+    else:
+        new_image = {'width': width, 'height': new_length}
+    if is_planar(image):
+        new_image['planes'] = tuple(map_buffer(plane) for plane in image['planes'])
+    else:
+        new_image['pixels'] = map_buffer(image['pixels'])
+    return new_image
+
+
+def image_without_seams(image, seams, vertical=True):
+    """
+    Returns a new image (greyscale, color or planar) without the pixels of
+    the given disjoint seams, each line being copied as slices around its
+    removed pixels.
+    """
+    positions = get_seam_lines(image, seams, vertical)
+
+    def remove(line, i):
+        new_line = line[:0]
+        previous = 0
+        for p in positions[i]:
+            new_line += line[previous:p]
+            previous = p + 1
+        new_line += line[previous:]
+        return new_line
+
+    length = get_seam_axes(image['width'], image['height'], vertical)[1]
+    return map_lines(image, remove, length - len(seams), vertical)
+
+
+def average_pixels(a, b):
+    """
+    Returns the (rounded) average of two greyscale or color pixels.
+    """
+    if isinstance(a, tuple):
+        return tuple(round((ca + cb) / 2) for ca, cb in zip(a, b))
+    return round((a + b) / 2)
+
+
+def image_with_seams(image, seams, vertical=True):
+    """
+    Returns a new image (greyscale, color or planar) in which a pixel is
+    inserted after each pixel of the given disjoint seams, the average of
+    that pixel and the next one on its line (or a copy of it at the end of
+    the line).
+    """
+    positions = get_seam_lines(image, seams, vertical)
+
+    def insert(line, i):
+        new_line = line[:0]
+        previous = 0
+        for p in positions[i]:
+            new_line += line[previous:p + 1]
+            new_line += line[p:p + 1]
+            new_line[-1] = average_pixels(line[p], line[min(p + 1, len(line) - 1)])
+            previous = p + 1
+        new_line += line[previous:]
+        return new_line
+
+    length = get_seam_axes(image['width'], image['height'], vertical)[1]
+    return map_lines(image, insert, length + len(seams), vertical)
+
+
+def image_without_seam(image, seam, vertical=True):
     """
     Given a (color) image and a list of indices to be removed from the image,
     return a new image (without modifying the original) that contains all the
     pixels from the original image except those corresponding to the locations
     in the given list.
-    """
-    pixels = image['pixels']
-    new_pixels = []
-    for i in range(len(pixels)):
-        if i not in seam:
-            new_pixels.append(pixels[i])
 
+    A seam has one index per row, so each row is copied as two slices around
+    its removed pixel (see image_without_columns). If vertical is False, the
+    seam is horizontal, with one index per column (see image_without_rows).
+    """
+    width = image['width']
+    height = image['height']
+    if not vertical:
+        return image_without_rows(image, seam_positions(seam, width, height, False))
+    if len(seam) == height and len({i // width for i in seam}) == height:
+        return image_without_columns(image, seam_positions(seam, width, height))
+
+    removed = set(seam)
     return {
-        'width': image['width'] - 1,
-        'height': image['height'],
-        'pixels': new_pixels
+        'width': width - 1,
+        'height': height,
+        'pixels': [pixel for i, pixel in enumerate(image['pixels'])
+                   if i not in removed]
     }
 
 
+def remove_columns(pixels, width, columns):
+    """
+    Returns a new buffer of the same type as pixels (a list or an array, in
+    row-major order with the given width) without the pixel at column
+    columns[y] of each row y.
+    """
+    new_pixels = pixels[:0]
+    for y, x in enumerate(columns):
+        start = y * width
+        new_pixels += pixels[start:start + x]
+        new_pixels += pixels[start + x + 1:start + width]
+    return new_pixels
+
+
+def remove_rows(pixels, width, rows):
+    """
+    Returns a new buffer of the same type as pixels (a list or an array, in
+    row-major order with the given width) without the pixel at row rows[x] of
+    each column x, moving the columns with strided slices.
+    """
+    new_pixels = pixels[:len(pixels) - width]
+    for x, y in enumerate(rows):
+        column = pixels[x::width]
+        new_pixels[x::width] = column[:y] + column[y + 1:]
+    return new_pixels
+
+
+def image_without_columns(image, columns):
+    """
+    Returns a new image (greyscale, color or planar) without the pixel at
+    column columns[y] of each row y, in O(width * height).
+    """
+    width = image['width']
+    new_image = {'width': width - 1, 'height': image['height']}
+    if is_planar(image):
+        new_image['planes'] = tuple(remove_columns(plane, width, columns)
+                                    for plane in image['planes'])
+    else:
+        new_image['pixels'] = remove_columns(image['pixels'], width, columns)
+    return new_image
+
+
+def image_without_rows(image, rows):
+    """
+    Returns a new image (greyscale, color or planar) without the pixel at row
+    rows[x] of each column x, in O(width * height).
+    """
+    width = image['width']
+    new_image = {'width': width, 'height': image['height'] - 1}
+    if is_planar(image):
+        new_image['planes'] = tuple(remove_rows(plane, width, rows)
+                                    for plane in image['planes'])
+    else:
+        new_image['pixels'] = remove_rows(image['pixels'], width, rows)
+    return new_image
+
+
+# SEAM CARVING PROFILING
+
+# The seam carving functions timed by profile_seams. Entry points come first,
+# so that stages called from them are recorded below them in the stacks.
+PROFILED_STAGES = (
+    'retarget', 'seam_carving', 'remove_seams', 'insert_seams',
+    'seam_carving_batches', 'greyscale_image_from_color_image',
+    'compute_energy', 'cumulative_energy_map', 'minimum_energy_seam',
+    'minimum_energy_seams', 'seam_positions', 'update_energy',
+    'update_cumulative_energy_map', 'image_without_seam',
+    'image_without_seams', 'image_with_seams', 'image_without_columns',
+    'image_without_rows', 'seam_carving_widths', 'cached_seam_order',
+    'seam_order', 'image_from_seam_order',
+)
+
+
+def profiled(profile, name, func):
+    """
+    Returns a version of func that appends a record of each call to the
+    profile (see profile_seams).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = profile['stack']
+        stack.append(name)
+        record = {'stack': ';'.join(stack), 'seconds': 0.0,
+                  'self_seconds': 0.0, 'bytes': None, 'net_bytes': None}
+        children = profile['children']
+        children.append(0.0)
+        peaks = profile['peaks']
+        if profile['memory']:
+            before, peak = tracemalloc.get_traced_memory()
+            if peaks:
+                # Resetting the peak below would lose the caller's peak so far
+                peaks[-1] = max(peaks[-1], peak)
+            peaks.append(before)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            if profile['memory']:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, peaks.pop())
+                if peaks:
+                    peaks[-1] = max(peaks[-1], peak)
+                record['bytes'] = peak - before
+                record['net_bytes'] = current - before
+            record['seconds'] = seconds
+            record['self_seconds'] = seconds - children.pop()
+            if children:
+                children[-1] += seconds
+            stack.pop()
+            profile['records'].append(record)
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile_seams(memory=False):
+    """
+    Context manager recording every call to the seam carving stages
+    (PROFILED_STAGES) made within it, e.g.:
+        with profile_seams() as profile:
+            seam_carving(image, 10)
+        print(profile_summary(profile))
+
+    Yields a profile dictionary whose 'records' list holds, in the order the
+    calls returned, the 'stack' of each call (the stage names from the
+    outermost profiled call, joined by ';'), its wall time in 'seconds' and
+    its 'self_seconds' (without the profiled stages it called). If memory is
+    True, 'bytes' holds the peak number of bytes it allocated (above the
+    memory in use when it was called, so including buffers it freed before
+    returning) and 'net_bytes' the number it allocated and did not free, as
+    traced by tracemalloc, which slows every call down.
+
+    The stages are wrapped only for the duration of the block: outside of
+    it, the seam carving functions run unchanged, with no overhead.
+    """
+    profile = {'memory': memory, 'records': [], 'stack': [], 'children': [],
+               'peaks': []}
+    originals = {name: globals()[name] for name in PROFILED_STAGES}
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        for name, func in originals.items():
+            globals()[name] = profiled(profile, name, func)
+        yield profile
+    finally:
+        globals().update(originals)
+        if tracing:
+            tracemalloc.stop()
+
+
+def profile_summary(profile):
+    """
+    Returns a dictionary mapping each stage called in the profile to its
+    number of 'calls', total 'seconds' and 'self_seconds', and total 'bytes'
+    and 'net_bytes' (None unless memory was traced).
+    """
+    summary = {}
+    for record in profile['records']:
+        name = record['stack'].rsplit(';', 1)[-1]
+        stage = summary.setdefault(name, {'calls': 0, 'seconds': 0.0,
+                                          'self_seconds': 0.0, 'bytes': None,
+                                          'net_bytes': None})
+        stage['calls'] += 1
+        stage['seconds'] += record['seconds']
+        stage['self_seconds'] += record['self_seconds']
+        if record['bytes'] is not None:
+            stage['bytes'] = (stage['bytes'] or 0) + record['bytes']
+            stage['net_bytes'] = (stage['net_bytes'] or 0) + record['net_bytes']
+    return summary
+
+
+def collapsed_stacks(profile):
+    """
+    Returns the profile in the "collapsed stack" format read by flame graph
+    tools (flamegraph.pl, speedscope, ...): one 'stack microseconds' line per
+    distinct stack, with the self time of its calls.
+    """
+    totals = {}
+    for record in profile['records']:
+        totals[record['stack']] = (totals.get(record['stack'], 0)
+                                   + record['self_seconds'])
+    return ['%s %d' % (stack, round(seconds * 1e6))
+            for stack, seconds in totals.items()]
+
+
+def write_profile(profile, filename, mode='json'):
+    """
+    Saves a profile to a file: its summary and records as JSON if mode is
+    'json', or its collapsed stacks if mode is 'collapsed'.
+    """
+    with open(filename, 'w') as f:
+        if mode == 'collapsed':
+            f.write('\n'.join(collapsed_stacks(profile)) + '\n')
+        elif mode == 'json':
+            json.dump({'summary': profile_summary(profile),
+                       'records': profile['records']}, f, indent=2)
+        else:
+            raise ValueError('Unknown profile format: %r' % mode)
+
+
 # HELPER FUNCTIONS FOR LOADING AND SAVING COLOR IMAGES
 
-def load_color_image(filename):
+def load_color_image(filename, planar=False):
     """
     Loads a color image from the given file and returns a dictionary
     representing that image.
 
+    If planar is True, the image is returned as a planar image, read straight
+    from PIL's bands. Otherwise the (r, g, b) tuples are zipped from slices of
+    PIL's raw interleaved bytes.
+
     Invoked as, for example:
        i = load_color_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img = img.convert('RGB')  # in case we were given a greyscale image
-        img_data = img.getdata()
-        pixels = list(img_data)
+        if planar:
+            w, h = img.size
+            return {
+                'height': h,
+                'width': w,
+                'planes': tuple(array('B', band.tobytes()) for band in img.split()),
+            }
+        data = img.tobytes()
+        pixels = list(zip(data[0::3], data[1::3], data[2::3]))
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
@@ -297,9 +1393,16 @@ def save_color_image(image, filename, mode='PNG'):
     is given as a string, the file type will be inferred from the given name.
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
+
+    Planes are shared with PIL rather than copied.
     """
-    out = Image.new(mode='RGB', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    size = (image['width'], image['height'])
+    if is_planar(image):
+        out = Image.merge('RGB', [Image.frombuffer('L', size, plane, 'raw', 'L', 0, 1)
+                                  for plane in image['planes']])
+    else:
+        out = Image.new(mode='RGB', size=size)
+        out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -307,26 +1410,20 @@ def save_color_image(image, filename, mode='PNG'):
     out.close()
 
 
-def load_greyscale_image(filename):
+def load_greyscale_image(filename, compact=False):
     """
     Loads an image from the given file and returns an instance of this class
     representing that image.  This also performs conversion to greyscale.
 
+    If compact is True, the pixels are returned in an array('B') (see
+    lab1.load_image).
+
     Invoked as, for example:
        i = load_greyscale_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
-        elif img.mode == 'L':
-            pixels = list(img_data)
-        else:
-            raise ValueError('Unsupported image mode: %r' % img.mode)
+        pixels = lab1.get_greyscale_pixels(img, compact)
         w, h = img.size
         return {'height': h, 'width': w, 'pixels': pixels}
 
@@ -338,8 +1435,7 @@ def save_greyscale_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    out = lab1.make_pil_image(image)
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -347,6 +1443,45 @@ def save_greyscale_image(image, filename, mode='PNG'):
     out.close()
 
 
+# STREAMING COLOR FILTERS
+
+def make_planar_band(data, width, height):
+    """
+    Returns the planar color image for a band of interleaved RGB rows.
+    """
+    return {
+        'height': height,
+        'width': width,
+        'planes': tuple(array('B', data[i::3]) for i in range(3)),
+    }
+
+
+def get_interleaved_bytes(image):
+    """
+    Returns the pixels of a (filtered) color image as interleaved RGB bytes.
+    """
+    if not is_planar(image):
+        image = compact_color_image(image)
+    data = bytearray(3 * image['width'] * image['height'])
+    for i, plane in enumerate(image['planes']):
+        data[i::3] = plane
+    return bytes(data)
+
+
+def color_filter_stream(src_path, dst_path, filt, n, band=64):
+    """
+    Applies the color filter filt, whose output pixels depend only on the nxn
+    window around them, to the image file at src_path and saves the result
+    to dst_path, keeping only about band + n rows in memory (see
+    lab1.filter_stream).
+    """
+    width, height, rows = lab1.read_rows(src_path, 'RGB')
+    lab1.write_rows(dst_path, width, height,
+                    lab1.filter_rows(rows, width, height, filt, n, band,
+                                     make_planar_band, get_interleaved_bytes),
+                    'RGB')
+
+
 if __name__ == '__main__':
     # code in this block will only be run when you explicitly run your script,
     # and not when the tests are being run.  this is a good place for
@@ -4,6 +4,7 @@ import os
 import lab
 import types
 import pickle
+import random
 import hashlib
 import collections
 
@@ -13,10 +14,34 @@ import pytest
 TEST_DIRECTORY = os.path.dirname(__file__)
 
 
+# A 4x3 color image for the tests of filters and seam removal
+SMALL_COLOR_IMAGE = {
+    'height': 3,
+    'width': 4,
+    'pixels': [(10, 200, 30), (40, 50, 60), (255, 0, 128), (1, 2, 3),
+               (90, 80, 70), (0, 0, 0), (12, 34, 56), (200, 100, 50),
+               (7, 8, 9), (250, 250, 250), (60, 50, 40), (33, 66, 99)],
+}
+
+
 def object_hash(x):
     return hashlib.sha512(pickle.dumps(x)).hexdigest()
 
 
+def striped_image(width, height, stripe, vertical=True):
+    """
+    Returns a width x height color image of varied pixels crossed by a blue
+    stripe: column stripe if vertical, else row stripe.
+    """
+    return {
+        'height': height,
+        'width': width,
+        'pixels': [((x * 37 + y * 91) % 256, (x * y * 13) % 256,
+                    255 if (x if vertical else y) == stripe else 0)
+                   for y in range(height) for x in range(width)],
+    }
+
+
 def compare_greyscale_images(im1, im2):
     assert set(im1.keys()) == {'height', 'width', 'pixels'}, 'Incorrect keys in dictionary'
     assert im1['height'] == im2['height'], 'Heights must match'
@@ -233,6 +258,343 @@ def test_cascades(cascade, image):
 
 
 
+def test_planar_color_images():
+    im = SMALL_COLOR_IMAGE
+    planar = lab.compact_color_image(im)
+    assert 'pixels' not in planar and len(planar['planes']) == 3
+    compare_color_images(lab.expand_color_image(planar), im)
+
+    for filt in (lab.inverted, lab.edges, lab.make_blur_filter(3)):
+        color_filter = lab.color_filter_from_greyscale_filter(filt)
+        result = color_filter(planar)
+        assert 'planes' in result
+        compare_color_images(lab.expand_color_image(result), color_filter(im))
+
+    # Channels that are not bytes any more cannot be stored as planes
+    halved = lab.color_filter_from_greyscale_filter(
+        lambda image: lab.lab1.apply_per_pixel(image, lambda c: c / 2))
+    result = halved(planar)
+    assert 'planes' not in result and result == halved(im)
+
+
+def test_color_io(tmp_path):
+    im = {
+        'height': 4,
+        'width': 6,
+        'pixels': [((i * 37) % 256, (i * 91) % 256, (i * 13) % 256) for i in range(24)],
+    }
+    path = str(tmp_path / 'color.png')
+    lab.save_color_image(im, path)
+    compare_color_images(lab.load_color_image(path), im)
+    planar = lab.load_color_image(path, planar=True)
+    assert planar == lab.compact_color_image(im)
+    lab.save_color_image(lab.color_filter_from_greyscale_filter(lab.inverted)(planar), path)
+    compare_color_images(lab.load_color_image(path),
+                         lab.color_filter_from_greyscale_filter(lab.inverted)(im))
+    grey = lab.load_greyscale_image(path, compact=True)
+    assert grey['pixels'].typecode == 'B'
+    lab.save_greyscale_image(grey, path)
+    assert lab.load_greyscale_image(path)['pixels'] == list(grey['pixels'])
+
+
+def test_parallel_color_filters():
+    im = SMALL_COLOR_IMAGE
+    for filt in (lab.edges, lab.make_sharpen_filter(3)):
+        expected = lab.color_filter_from_greyscale_filter(filt)(im)
+        parallel = lab.color_filter_from_greyscale_filter(filt, workers=3)
+        compare_color_images(parallel(im), expected)
+        result = parallel(lab.compact_color_image(im))
+        compare_color_images(lab.expand_color_image(result), expected)
+
+
+def test_cascade_plan():
+    im = SMALL_COLOR_IMAGE
+    color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
+    color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+    color_sharpen = lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(3))
+    filters = [color_blur, color_inverted, color_inverted, color_sharpen, color_inverted]
+    exact = lab.filter_cascade(filters)
+    assert exact.plan == [color_blur, color_sharpen, color_inverted]
+    expected = im
+    for filt in filters:
+        expected = filt(expected)
+    compare_color_images(exact(im), expected)
+
+    fused = lab.filter_cascade(filters, exact=False)
+    assert len(fused.plan) == 2 and fused.plan[1] is color_inverted
+    assert lab.get_filter_kernel(fused.plan[0].filt) == lab.convolve_kernels(
+        lab.lab1.get_boxblur(3), lab.lab1.get_sharpkernel(3))
+    assert fused.plan[0].filt.keywords['kernel']['size'] == 5
+    result = fused(im)
+    assert len(result['pixels']) == 12 and all(len(pixel) == 3 for pixel in result['pixels'])
+
+    oim = object_hash(im)
+    grey = {'height': 1, 'width': 3, 'pixels': [0, 128, 255]}
+    cancelled = lab.filter_cascade([lab.inverted, lab.inverted])
+    assert cancelled.plan == []
+    for image in (im, grey, lab.compact_color_image(im)):
+        result = cancelled(image)
+        assert result == image
+        if lab.is_planar(image):
+            assert all(a is not b for a, b in zip(result['planes'], image['planes']))
+        else:
+            assert result['pixels'] is not image['pixels']
+    result = lab.filter_cascade([color_inverted, color_inverted])(im)
+    result['pixels'][0] = (99, 99, 99)
+    assert object_hash(im) == oim
+
+
+def test_planar_cascade(tmp_path):
+    im = SMALL_COLOR_IMAGE
+    swap = lambda im: {k: ([(i[1], i[0], i[2]) for i in v] if isinstance(v, list) else v) for k, v in im.items()}
+    filters = [lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)),
+               lab.color_filter_from_greyscale_filter(lab.edges),
+               swap,
+               lab.color_filter_from_greyscale_filter(lab.inverted)]
+    expected = im
+    for filt in filters:
+        expected = filt(expected)
+    compare_color_images(lab.filter_cascade(filters)(im), expected)
+    result = lab.filter_cascade(filters)(lab.compact_color_image(im))
+    compare_color_images(lab.expand_color_image(result), expected)
+
+    filename = str(tmp_path / 'im.png')
+    lab.save_color_image(im, filename)
+    planar = lab.load_color_image(filename, planar=True)
+    compare_color_images(lab.expand_color_image(planar), lab.load_color_image(filename))
+
+
+def test_incremental_seam_energy():
+    im = striped_image(7, 5, 3)
+    grey = lab.greyscale_image_from_color_image(im)
+    energy = lab.compute_energy(grey)
+    cem = lab.cumulative_energy_map(energy)
+    while grey['width'] > 1:
+        seam = lab.minimum_energy_seam(cem)
+        columns = lab.seam_positions(seam, grey['width'], grey['height'])
+        grey = lab.image_without_seam(grey, seam)
+        energy = lab.image_without_seam(energy, seam)
+        cem = lab.image_without_seam(cem, seam)
+        spans = lab.update_energy(grey, energy, columns)
+        lab.update_cumulative_energy_map(cem, energy, spans)
+        compare_greyscale_images(energy, lab.compute_energy(grey))
+        compare_greyscale_images(cem, lab.cumulative_energy_map(lab.compute_energy(grey)))
+
+
+def test_cumulative_energy_backpointers():
+    energy = {
+        'width': 5,
+        'height': 4,
+        'pixels': [3, 1, 1, 4, 0,
+                   2, 2, 0, 1, 9,
+                   1, 5, 5, 5, 1,
+                   0, 7, 7, 7, 7],
+    }
+    expected = [3, 1, 1, 4, 0,
+                3, 3, 1, 1, 9,
+                4, 6, 6, 6, 2,
+                4, 11, 13, 9, 9]
+    cem, back = lab.cumulative_energy_map(energy, backpointers=True)
+    compare_greyscale_images(cem, {'width': 5, 'height': 4, 'pixels': expected})
+    assert back[5:10] == [1, 1, 1, 4, 4]
+    assert back[-5:] == [0, 0, 1, 4, 4]
+    seam = lab.minimum_energy_seam(cem)
+    assert seam == lab.minimum_energy_seam(cem, back) == [15, 10, 5, 1]
+
+    floats = {'width': 3, 'height': 2, 'pixels': [0.5, 1.5, 2.5, 0.4, 0.4, 0.4]}
+    compact = dict(energy, pixels=lab.lab1.array('B', energy['pixels']))
+    cases = [(image, vertical) for image in (energy, floats, compact)
+             for vertical in (True, False)]
+    expected_maps = [lab.cumulative_energy_map(image, True, vertical)
+                     for image, vertical in cases]
+    if lab.lab1.np is not None:
+        try:
+            lab.lab1.set_backend('numpy')
+            for (image, vertical), exp in zip(cases, expected_maps):
+                assert lab.cumulative_energy_map(image, True, vertical) == exp
+        finally:
+            lab.lab1.set_backend('python')
+    assert lab.cumulative_energy_map(floats)['pixels'] == [0.5, 1.5, 2.5, 0.9, 0.9, 1.9]
+
+
+def test_seamcarving_batches():
+    im = striped_image(9, 6, 4)
+    oim = object_hash(im)
+    compare_color_images(lab.seam_carving(im, 3, batch=1), lab.seam_carving(im, 3))
+    cem = lab.cumulative_energy_map(lab.compute_energy(lab.greyscale_image_from_color_image(im)))
+    seams = lab.minimum_energy_seams(cem, 4)
+    assert len(seams) == 4 and seams[0] == lab.minimum_energy_seam(cem)
+    assert len({i for seam in seams for i in seam}) == 4 * 6
+    assert all(sorted(i // 9 for i in seam) == list(range(6)) for seam in seams)
+    for batch in (2, 4, 8):
+        result = lab.seam_carving(im, 5, batch=batch)
+        assert result['width'] == 4 and len(result['pixels']) == 4 * 6
+        assert set(result['pixels']) <= set(im['pixels'])
+    assert object_hash(im) == oim
+
+
+def test_minimum_energy_seams_do_not_cross():
+    rng = random.Random(0)
+    for width, height, vertical in ((20, 15, True), (12, 9, True), (9, 14, False)):
+        for _ in range(10):
+            im = {
+                'height': height,
+                'width': width,
+                'pixels': [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                           for _ in range(width * height)],
+            }
+            grey = lab.greyscale_image_from_color_image(im)
+            cem = lab.cumulative_energy_map(lab.compute_energy(grey), vertical=vertical)
+            seams = lab.minimum_energy_seams(cem, 8, vertical)
+            assert 1 <= len(seams) <= 8
+            assert seams[0] == lab.minimum_energy_seam(cem, vertical=vertical)
+            paths = [lab.seam_positions(seam, width, height, vertical) for seam in seams]
+            for path in paths:
+                assert all(abs(a - b) <= 1 for a, b in zip(path, path[1:]))
+            for i, first in enumerate(paths):
+                for second in paths[i + 1:]:
+                    gaps = [a - b for a, b in zip(first, second)]
+                    assert all(g < 0 for g in gaps) or all(g > 0 for g in gaps)
+
+
+def test_image_without_seam():
+    im = SMALL_COLOR_IMAGE
+    expected = {
+        'height': 3,
+        'width': 3,
+        'pixels': [(10, 200, 30), (40, 50, 60), (1, 2, 3),
+                   (90, 80, 70), (12, 34, 56), (200, 100, 50),
+                   (250, 250, 250), (60, 50, 40), (33, 66, 99)],
+    }
+    seam = [8, 5, 2]
+    compare_color_images(lab.image_without_seam(im, seam), expected)
+    planar = lab.image_without_seam(lab.compact_color_image(im), seam)
+    compare_color_images(lab.expand_color_image(planar), expected)
+    assert lab.image_without_columns(im, [2, 1, 0]) == expected
+
+
+def test_horizontal_seams():
+    def transposed(im):
+        w, h = im['width'], im['height']
+        return {'height': w, 'width': h,
+                'pixels': [im['pixels'][y * w + x] for x in range(w) for y in range(h)]}
+
+    im = striped_image(9, 12, 5, vertical=False)
+    for n in (1, 4):
+        result = lab.remove_seams(im, n, vertical=False)
+        assert (result['width'], result['height']) == (9, 12 - n)
+        assert result == transposed(lab.seam_carving(transposed(im), n))
+        planar = lab.remove_seams(lab.compact_color_image(im), n, vertical=False)
+        compare_color_images(lab.expand_color_image(planar), result)
+        result = lab.insert_seams(im, n, vertical=False)
+        assert (result['width'], result['height']) == (9, 12 + n)
+        assert result == transposed(lab.insert_seams(transposed(im), n))
+
+    resized = lab.retarget(im, 6, 15)
+    assert (resized['width'], resized['height']) == (6, 15)
+    assert len(resized['pixels']) == 6 * 15
+
+    small = {'height': 2, 'width': 3, 'pixels': im['pixels'][:6]}
+    for result in (lab.retarget(small, 8, 2), lab.insert_seams(small, 5)):
+        assert (result['width'], result['height']) == (8, 2)
+        assert len(result['pixels']) == 8 * 2
+    result = lab.insert_seams(lab.compact_color_image(small), 7, vertical=False)
+    assert (result['width'], result['height']) == (3, 9)
+    assert all(len(plane) == 3 * 9 for plane in result['planes'])
+
+
+def test_image_with_seams():
+    im = {
+        'height': 2,
+        'width': 3,
+        'pixels': [(10, 20, 30), (20, 40, 61), (0, 0, 0),
+                   (1, 2, 3), (4, 5, 6), (7, 8, 9)],
+    }
+    expected = {
+        'height': 2,
+        'width': 4,
+        'pixels': [(10, 20, 30), (15, 30, 46), (20, 40, 61), (0, 0, 0),
+                   (1, 2, 3), (4, 5, 6), (7, 8, 9), (7, 8, 9)],
+    }
+    compare_color_images(lab.image_with_seams(im, [[5, 0]]), expected)
+    expected = {
+        'height': 3,
+        'width': 3,
+        'pixels': [(10, 20, 30), (20, 40, 61), (0, 0, 0),
+                   (6, 11, 16), (12, 22, 34), (7, 8, 9),
+                   (1, 2, 3), (4, 5, 6), (7, 8, 9)],
+    }
+    compare_color_images(lab.image_with_seams(im, [[0, 1, 5]], vertical=False),
+                         expected)
+
+
+def test_seam_order_cache():
+    im = striped_image(10, 7, 4)
+    oim = object_hash(im)
+    order = lab.seam_order(im, 6)
+    assert sorted(order['pixels']).count(6) == 4 * 7
+    for count in range(7):
+        assert lab.image_from_seam_order(im, order, count) == lab.seam_carving(im, count)
+    order = lab.seam_order(im, 4, vertical=False)
+    for count in range(5):
+        assert (lab.image_from_seam_order(im, order, count, vertical=False)
+                == lab.remove_seams(im, count, vertical=False))
+
+    lab.SEAM_ORDER_CACHE.clear()
+    results = lab.seam_carving_widths(im, [9, 6, 10])
+    assert results == [lab.seam_carving(im, 1), lab.seam_carving(im, 4), im]
+    assert len(lab.SEAM_ORDER_CACHE) == 1
+    order = lab.cached_seam_order(im, 4)
+    assert lab.cached_seam_order(dict(im, pixels=im['pixels'][:]), 2) is order
+    assert lab.cached_seam_order(lab.compact_color_image(im), 2) is order
+    for size in range(lab.SEAM_ORDER_CACHE_SIZE + 1):
+        lab.cached_seam_order(dict(im, pixels=im['pixels'][size:] + im['pixels'][:size]), 1)
+    assert len(lab.SEAM_ORDER_CACHE) == lab.SEAM_ORDER_CACHE_SIZE
+    assert object_hash(im) == oim
+
+
+def test_profile_seams(tmp_path):
+    im = striped_image(9, 6, 4)
+    seam_carving = lab.seam_carving
+    with lab.profile_seams() as profile:
+        result = lab.seam_carving(im, 3)
+    assert lab.seam_carving is seam_carving
+    compare_color_images(result, lab.seam_carving(im, 3))
+    summary = lab.profile_summary(profile)
+    assert summary['seam_carving']['calls'] == 1
+    assert summary['minimum_energy_seam']['calls'] == 3
+    assert summary['compute_energy']['calls'] == 1
+    assert summary['update_energy']['bytes'] is None
+    assert all(0 <= stage['self_seconds'] <= stage['seconds']
+               for stage in summary.values())
+    stacks = lab.collapsed_stacks(profile)
+    assert 'seam_carving;remove_seams;minimum_energy_seam' in [
+        line.rsplit(' ', 1)[0] for line in stacks]
+
+    with lab.profile_seams(memory=True) as profile:
+        lab.seam_carving(im, 1)
+    assert lab.profile_summary(profile)['seam_carving']['bytes'] is not None
+    lab.write_profile(profile, tmp_path / 'profile.txt', 'collapsed')
+    assert (tmp_path / 'profile.txt').read_text().startswith('seam_carving;remove_seams;')
+
+
+def test_profile_seams_peak_bytes(monkeypatch):
+    compute_energy = lab.compute_energy
+
+    def wasteful_energy(image):
+        buffer = bytearray(10 ** 7)
+        del buffer
+        return compute_energy(image)
+    monkeypatch.setattr(lab, 'compute_energy', wasteful_energy)
+    with lab.profile_seams(memory=True) as profile:
+        lab.seam_carving(striped_image(9, 6, 4), 1)
+    summary = lab.profile_summary(profile)
+    # The freed buffer counts for the stage and for its callers
+    for name in ('compute_energy', 'seam_carving'):
+        assert summary[name]['bytes'] >= 10 ** 7
+        assert summary[name]['net_bytes'] < 10 ** 6
+
+
 def seams_endtoend(inp_name, out_name, number):
     inpfile = os.path.join(TEST_DIRECTORY, 'test_images', inp_name)
 